@@ -0,0 +1,88 @@
+"""
+Microbenchmark of the hot queries of the ETM database.
+
+Compares the former peewee query builder calls with the constant SQL fast
+path used by `plugins.eh_telegram_master.db` for `get_chat_assoc`,
+`add_msg_log` and `get_msg_log`. Caches in front of these functions are
+left out, so that only the queries are measured. The statements, models
+and schema are those of the module; requires peewee and `config.py`.
+
+Importing the module opens and migrates the ETM database as on start of
+EFB, the benchmark itself then runs on a new database in a temporary
+directory.
+
+Usage (from the EFB root directory):
+    python3 -m benchmarks.db_queries [rounds]
+"""
+import os
+import sys
+import time
+import datetime
+import tempfile
+from peewee import DoesNotExist
+from plugins.eh_telegram_master import db
+
+
+def entry(i):
+    return db.MsgLogRow(master_msg_id="-100%s.%s" % (i % 50, i), text="Message %s" % i,
+                        slave_origin_uid="eh_wechat_slave.%s" % (i % 50), slave_origin_display_name="Chat",
+                        slave_member_uid=None, slave_member_display_name=None, msg_type="Text",
+                        sent_to="Master", time=datetime.datetime.now(), chat_id=int("-100%s" % (i % 50)),
+                        message_id=i)
+
+
+def builder_get_chat_assoc(i):
+    try:
+        return db.ChatAssoc.get(db.ChatAssoc.master_uid == "eh_telegram_master.%s" % (i % 50)).slave_uid
+    except DoesNotExist:
+        return None
+
+
+def fast_get_chat_assoc(i):
+    row = db.db.execute_sql(db._SQL_GET_SLAVE_UID, ("eh_telegram_master.%s" % (i % 50),)).fetchone()
+    return row[0] if row else None
+
+
+def builder_add_msg_log(i):
+    return db.MsgLog.insert(**entry(i)._asdict()).on_conflict('REPLACE').execute()
+
+
+def fast_add_msg_log(i):
+    return db._put_msg_log(entry(i))
+
+
+def builder_get_msg_log(i):
+    return db.MsgLog.select().where(db.MsgLog.master_msg_id == "-100%s.%s" % (i % 50, i)).first()
+
+
+def fast_get_msg_log(i):
+    return db._msg_log_row(db.db.execute_sql(db._SQL_GET_MSG_LOG, ("-100%s.%s" % (i % 50, i),)).fetchone())
+
+
+def bench(fn, rounds):
+    start = time.perf_counter()
+    with db.db.atomic():
+        for i in range(rounds):
+            fn(i)
+    return (time.perf_counter() - start) / rounds * 1000000
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as tmp:
+        db.release_connection()
+        db.db.init(os.path.join(tmp, "tgdata.db"))
+        db.db.connect()
+        db._create()
+        for i in range(50):
+            db.ChatAssoc.create(master_uid="eh_telegram_master.%s" % i, slave_uid="eh_wechat_slave.%s" % i)
+        print("%-24s %14s %14s" % ("Query", "Builder (us)", "Fast (us)"))
+        for name, builder, fast in [("add_msg_log", builder_add_msg_log, fast_add_msg_log),
+                                    ("get_chat_assoc", builder_get_chat_assoc, fast_get_chat_assoc),
+                                    ("get_msg_log", builder_get_msg_log, fast_get_msg_log)]:
+            print("%-24s %14.1f %14.1f" % (name, bench(builder, rounds), bench(fast, rounds)))
+        db.release_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of image to GIF conversion used by EWS for outbound stickers.
+
+Compares the former per-pixel `Image.eval` callback path with the
+lookup-table path in `plugins.eh_wechat_slave.convert_to_gif`, over
+typical Telegram sticker sizes.
+
+Usage (from the EFB root directory):
+    python3 -m benchmarks.gif_conversion [rounds]
+"""
+import os
+import sys
+import time
+import tempfile
+from PIL import Image
+from plugins.eh_wechat_slave import convert_to_gif
+
+SIZES = [(128, 128), (256, 256), (512, 512)]
+
+
+def legacy_convert_to_gif(path, dest):
+    img = Image.open(path)
+    try:
+        alpha = img.split()[3]
+        mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
+    except IndexError:
+        mask = Image.eval(img.split()[0], lambda a: 0)
+    img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
+    img.paste(255, mask)
+    img.save(dest, transparency=255)
+    return dest
+
+
+def make_sticker(path, size):
+    img = Image.frombytes("RGBA", size, os.urandom(size[0] * size[1] * 4))
+    img.save(path, "PNG")
+
+
+def bench(fn, path, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        os.remove(fn(path, "%s.gif" % path))
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        print("%-10s %12s %12s" % ("Size", "Legacy (ms)", "LUT (ms)"))
+        for size in SIZES:
+            path = os.path.join(tmp, "sticker_%sx%s.png" % size)
+            make_sticker(path, size)
+            legacy = bench(legacy_convert_to_gif, path, rounds)
+            lut = bench(convert_to_gif, path, rounds)
+            print("%-10s %12.2f %12.2f" % ("%sx%s" % size, legacy, lut))
+
+
+if __name__ == '__main__':
+    main()
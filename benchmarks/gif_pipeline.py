@@ -0,0 +1,58 @@
+"""
+Benchmark of video to GIF conversion used by ETM for Telegram GIFs.
+
+Compares the former moviepy path (`VideoFileClip.write_gif`) with the
+single-pass ffmpeg pipeline in `plugins.eh_telegram_master.transcode`.
+moviepy is no longer a dependency of EFB, install it separately to run
+the comparison.
+
+Usage (from the EFB root directory):
+    python3 -m benchmarks.gif_pipeline clip1.mp4 [clip2.mp4 ...]
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+import importlib.util
+
+# Load the transcoder without importing the ETM package, which connects to
+# Telegram and the database on import.
+spec = importlib.util.spec_from_file_location(
+    "transcode", os.path.join("plugins", "eh_telegram_master", "transcode.py"))
+transcode = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(transcode)
+
+
+def moviepy_gif(src, dest):
+    from moviepy.editor import VideoFileClip
+    VideoFileClip(src).write_gif(dest, program="ffmpeg", verbose=False)
+
+
+def bench(fn, src, dest):
+    start = time.perf_counter()
+    fn(src, dest)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(dest)
+    os.remove(dest)
+    return elapsed * 1000, size / 1024
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    transcoder = transcode.Transcoder(workers=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        dest = os.path.join(tmp, "out.gif")
+        print("%-30s %14s %14s %14s %14s" % ("Clip", "moviepy (ms)", "moviepy (KiB)", "ffmpeg (ms)", "ffmpeg (KiB)"))
+        for clip in sys.argv[1:]:
+            old = bench(moviepy_gif, clip, dest)
+            new = bench(transcoder.gif, clip, dest)
+            print("%-30s %14.0f %14.0f %14.0f %14.0f" % ((os.path.basename(clip)[:30],) + old + new))
+    print("Peak RSS of this process (moviepy decodes in-process): %.1f MiB" %
+          (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark of looking up the entries of a chat in the ETM message log.
+
+Compares a lookup by `master_msg_id` prefix, the only way to find the
+entries of a chat before the `chat_id` column, with the lookup on the
+indexed `chat_id` column, on message logs of growing size. The query
+walks the entries of a chat from the latest, as the per-chat retention
+of `plugins.eh_telegram_master.db._MsgLogPruner` does; the chat filter of
+`/search` uses the same index. The schema mirrors the `MsgLog` table
+created by peewee.
+
+Usage (from the EFB root directory):
+    python3 -m benchmarks.msglog_lookup [max_rows] [chats]
+
+e.g. `python3 -m benchmarks.msglog_lookup 20000000` for tens of millions
+of rows; the database is built in a temporary directory, and takes about
+as much disk space as the message log of the same size.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import datetime
+import tempfile
+
+SCHEMA = """
+CREATE TABLE msglog (
+    master_msg_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    text VARCHAR(255) NOT NULL,
+    slave_origin_uid VARCHAR(255) NOT NULL,
+    slave_origin_display_name VARCHAR(255),
+    slave_member_uid VARCHAR(255),
+    slave_member_display_name VARCHAR(255),
+    msg_type VARCHAR(255) NOT NULL,
+    sent_to VARCHAR(255) NOT NULL,
+    time DATETIME,
+    chat_id INTEGER,
+    message_id INTEGER
+);
+CREATE INDEX msglog_chat_id_time ON msglog (chat_id, time);
+"""
+
+LEGACY = "SELECT rowid, time FROM msglog WHERE master_msg_id LIKE ? ORDER BY time DESC LIMIT 100"
+INDEXED = "SELECT rowid, time FROM msglog WHERE chat_id = ? ORDER BY time DESC LIMIT 100"
+
+
+def fill(conn, start, end, chats):
+    epoch = datetime.datetime(2017, 1, 1)
+    rows = []
+    for i in range(start, end):
+        chat_id = -100000 - i % chats
+        rows.append(("%s.%s" % (chat_id, i), "Message %s" % i, "eh_wechat_slave.%s" % (i % chats),
+                     "Chat", None, None, "Text", "Master",
+                     str(epoch + datetime.timedelta(seconds=i)), chat_id, i))
+        if len(rows) >= 100000:
+            conn.executemany("INSERT INTO msglog VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows)
+            rows = []
+    conn.executemany("INSERT INTO msglog VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows)
+    conn.commit()
+
+
+def bench(conn, sql, params, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        conn.execute(sql, params[i % len(params)]).fetchall()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    chat_ids = [-100000 - random.randrange(chats) for _ in range(100)]
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "tgdata.db"))
+        conn.executescript(SCHEMA)
+        print("%-12s %14s %14s" % ("Rows", "Prefix (ms)", "Indexed (ms)"))
+        rows = 0
+        size = 10000
+        while rows < max_rows:
+            size = min(size, max_rows)
+            fill(conn, rows, size, chats)
+            rows = size
+            legacy = bench(conn, LEGACY, [("%s.%%" % i,) for i in chat_ids], 5)
+            indexed = bench(conn, INDEXED, [(i,) for i in chat_ids], 1000)
+            print("%-12s %14.3f %14.3f" % (rows, legacy, indexed))
+            size *= 10
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
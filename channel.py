@@ -1,3 +1,11 @@
+import io
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
 # Constants Objects
 
 class MsgType:
@@ -60,6 +68,32 @@ class EFBChannel:
     def send_message(self, *args, **kwargs):
         return "Not implemented"
 
+    def reserve_send(self, chat_uid):
+        """Reserve the send budget of a chat for the next message to it.
+
+        Called by master channels before handing a message over to a
+        sending thread, so that chats over the rate limits of the slave
+        channel wait without holding up messages to other chats.
+
+        Args:
+            chat_uid (str): UID of the chat in the slave channel
+
+        Returns:
+            float: 0 if the next message can be sent now, otherwise the
+                time in seconds to wait before trying again.
+        """
+        return 0
+
+    def release_send(self, chat_uid):
+        """Return the send budget reserved with `reserve_send`, if it is
+        not used by a message, e.g. when the message failed before it is
+        sent. Called by master channels after each message handed over.
+
+        Args:
+            chat_uid (str): UID of the chat in the slave channel
+        """
+        pass
+
     def poll(self, *args, **kwargs):
         return "Not implemented"
 
@@ -67,6 +101,266 @@ class EFBChannel:
         return "Not implemented"
 
 
+class EFBMedia:
+    """Media payload of a message.
+
+    Payloads up to `spool_size` bytes are kept in memory, larger ones are
+    spilled to a temporary file in `spool_dir`. Consumers should read the
+    payload with `open()` or `read()`, and use `path` only when a file on
+    disk is really needed, as it writes in-memory payloads to disk.
+
+    A payload should be released with `close()` (or a `with` statement)
+    once it is delivered, which closes all file objects opened from it and
+    removes its temporary file.
+
+    A payload can be `deferred`: its content is only fetched when it is
+    first read, so media that is never delivered is never downloaded.
+
+    Attributes:
+        mime (str): MIME type of the payload. `None` if unknown
+        name (str): File name of the payload, including extension. `None` if N/A
+        size (int): Size of the payload in bytes. `None` if unknown before fetching
+        spool_dir (str): Directory to spill large payloads to
+    """
+    spool_size = 4 * 1024 * 1024
+
+    def __init__(self, mime=None, name=None, spool_dir=None):
+        self.mime = mime
+        self.name = name
+        self.size = 0
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self._buffer = io.BytesIO()
+        self._writer = None
+        self._path = None
+        self._owned = True
+        self._digest = None
+        self._handles = []
+        self._fetch = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_bytes(cls, data, mime=None, name=None, spool_dir=None):
+        """Create a payload from bytes.
+
+        Args:
+            data (bytes): Content of the payload
+            mime (str): MIME type of the payload
+            name (str): File name of the payload
+            spool_dir (str): Directory to spill large payloads to
+
+        Returns:
+            EFBMedia: The payload
+        """
+        media = cls(mime, name, spool_dir)
+        media.write(data)
+        return media
+
+    @classmethod
+    def from_path(cls, path, mime=None, name=None, owned=True):
+        """Create a payload backed by an existing file.
+
+        Args:
+            path (str): Path to the file
+            mime (str): MIME type of the payload
+            name (str): File name of the payload, base name of `path` by default
+            owned (bool): Remove the file when the payload is closed, `True` by default
+
+        Returns:
+            EFBMedia: The payload
+        """
+        media = cls(mime, name or os.path.basename(path), os.path.dirname(path))
+        media._buffer = None
+        media._path = path
+        media._owned = owned
+        media.size = os.path.getsize(path)
+        return media
+
+    @classmethod
+    def deferred(cls, fetch, size=None, mime=None, name=None, spool_dir=None):
+        """Create a payload whose content is fetched on first access.
+
+        Args:
+            fetch (callable): Function taking the payload as its only argument,
+                which writes the content with `write()`. It may also update `mime` and `name`.
+            size (int): Size of the payload in bytes if known before fetching
+            mime (str): MIME type of the payload if known before fetching
+            name (str): File name of the payload
+            spool_dir (str): Directory to spill large payloads to
+
+        Returns:
+            EFBMedia: The payload
+        """
+        media = cls(mime, name, spool_dir)
+        media.size = size
+        media._fetch = fetch
+        return media
+
+    @property
+    def loaded(self):
+        """bool: If the content of the payload is available."""
+        return self._fetch is None
+
+    def load(self):
+        """Fetch the content of a deferred payload, if not yet fetched.
+
+        Returns:
+            EFBMedia: The payload itself
+        """
+        with self._lock:
+            if self._fetch is None:
+                return self
+            fetch, size = self._fetch, self.size
+            self._fetch = None
+            self.size = 0
+            try:
+                fetch(self)
+            except Exception:
+                if self._writer:
+                    self._writer.close()
+                    self._writer = None
+                if self._path and self._owned and os.path.exists(self._path):
+                    os.remove(self._path)
+                self._fetch, self.size = fetch, size
+                self._buffer, self._path = io.BytesIO(), None
+                raise
+        return self
+
+    @property
+    def in_memory(self):
+        """bool: If the payload is kept in memory."""
+        return self._buffer is not None
+
+    def _mkstemp(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        # The name may come from the sender, keep it from leaving spool_dir.
+        name = os.path.basename(self.name or "")
+        for sep in (os.sep, os.altsep):
+            if sep:
+                name = name.replace(sep, "")
+        name, ext = os.path.splitext(name)
+        return tempfile.mkstemp(suffix=ext, prefix="%s_" % name if name else "tmp", dir=self.spool_dir)
+
+    def _spill(self):
+        fd, self._path = self._mkstemp()
+        self._writer = os.fdopen(fd, "wb")
+        self._writer.write(self._buffer.getbuffer())
+        self._buffer = None
+        self._owned = True
+
+    def write(self, data):
+        """Append data to the payload.
+
+        Args:
+            data (bytes): Data to append
+        """
+        if self.in_memory and self.size + len(data) > self.spool_size:
+            self._spill()
+        if self.in_memory:
+            self._buffer.write(data)
+        else:
+            if self._writer is None:
+                self._writer = open(self._path, "ab")
+            self._writer.write(data)
+        self.size += len(data)
+        self._digest = None
+
+    @property
+    def path(self):
+        """str: Path to the payload on disk, written to disk on first access if kept in memory."""
+        self.load()
+        if self.in_memory:
+            self._spill()
+        if self._writer:
+            self._writer.flush()
+        return self._path
+
+    def open(self):
+        """Open the payload for reading from the start.
+
+        Returns:
+            file: A binary file object, closed when the payload is closed.
+        """
+        self.load()
+        if self.in_memory:
+            f = io.BytesIO(self._buffer.getvalue())
+            f.name = self.name or "file"
+        else:
+            f = open(self.path, "rb")
+        self._handles.append(f)
+        return f
+
+    def read(self, size=-1):
+        """Read the payload from the start.
+
+        Args:
+            size (int): Maximum number of bytes to read, -1 to read all
+
+        Returns:
+            bytes: Content of the payload
+        """
+        self.load()
+        if self.in_memory:
+            return self._buffer.getvalue()[:size] if size >= 0 else self._buffer.getvalue()
+        with open(self.path, "rb") as f:
+            return f.read(size)
+
+    def digest(self):
+        """Get the SHA-1 hex digest of the payload.
+
+        Returns:
+            str: Hex digest
+        """
+        self.load()
+        if self._digest is None:
+            h = hashlib.sha1()
+            if self.in_memory:
+                h.update(self._buffer.getbuffer())
+            else:
+                with open(self.path, "rb") as f:
+                    for chunk in iter(lambda: f.read(65536), b""):
+                        h.update(chunk)
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def copy(self):
+        """Create an independent copy of the payload, fetching it first if deferred.
+
+        Returns:
+            EFBMedia: The copy, to be closed separately
+        """
+        self.load()
+        media = EFBMedia(self.mime, self.name, self.spool_dir)
+        if self.in_memory:
+            media.write(self._buffer.getbuffer())
+        else:
+            fd, media._path = media._mkstemp()
+            os.close(fd)
+            shutil.copyfile(self.path, media._path)
+            media._buffer = None
+            media.size = self.size
+        return media
+
+    def close(self):
+        """Release the payload, its file objects, and its temporary file."""
+        self._fetch = None
+        for f in self._handles:
+            f.close()
+        self._handles = []
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._path and self._owned and os.path.exists(self._path):
+            os.remove(self._path)
+        self._buffer = None
+        self._path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class EFBMsg:
     """A message.
 
@@ -81,11 +375,15 @@ class EFBMsg:
         source (MsgSource): Source of message: User/Group/System
         target (dict): Target (refers to @ messages and "reply to" messages.)
         text (str): text of the message
+        time (float): Unix timestamp when the message is sent, defaults to when it is created
         type (MsgType): Type of message
         uid (str): Unique ID of message
         url (str): URL of multimedia file/Link share. `None` if N/A
+        media (EFBMedia): Payload of multimedia file. `None` if N/A
         path (str): Local path of multimedia file. `None` if N/A
+            Deprecated, use `media` instead. Writes the payload to disk if it is kept in memory.
         file (file): File object to multimedia object, type "ra". `None` if N/A
+            Deprecated, use `media` instead.
         mime (str): MIME type of the file. `None` if N/A
 
     `target`:
@@ -219,13 +517,49 @@ class EFBMsg:
     uid = "Message UID"
     text = "Message"
     url = None
-    path = None
-    file = None
+    media = None
     mime = None
     attributes = {}
+    _path = None
+    _file = None
 
     def __init__(self, channel=None):
+        self.time = time.time()
         if isinstance(channel, EFBChannel):
             self.channel_name = channel.channel_name
             self.channel_emoji = channel.channel_emoji
             self.channel_id = channel.channel_id
+
+    @property
+    def path(self):
+        if self.media:
+            return self.media.path
+        return self._path
+
+    @path.setter
+    def path(self, value):
+        self._path = value
+
+    @property
+    def file(self):
+        if self.media:
+            return self.media.open()
+        return self._file
+
+    @file.setter
+    def file(self, value):
+        self._file = value
+
+    def get_media(self):
+        """Get the media payload of the message.
+        Messages carrying only a `path` from channels not using `EFBMedia`
+        are wrapped into a payload owning the file.
+
+        Returns:
+            EFBMedia|None: The payload, `None` if N/A
+        """
+        if not self.media and self._path:
+            if self._file:
+                self._file.close()
+            self.media = EFBMedia.from_path(self._path, self.mime)
+        return self.media
@@ -39,3 +39,10 @@ eh_telegram_master = {
         "secret_key": "2b7e151628ae082b7e151628ae08"
     }
 }
+
+eh_wechat_slave = {
+    "rules": [
+        # {"mp": True, "action": "drop"},
+        # {"group": True, "min_members": 200, "types": ["Picture", "Video", "Attachment"], "action": "text"},
+    ]
+}
@@ -1,5 +1,5 @@
 import config
-import queue
+import utils
 import threading
 import logging
 import argparse
@@ -49,7 +49,7 @@ def init():
     """
     global q, slaves, master, master_thread, slave_threads
     # Init Queue
-    q = queue.Queue()
+    q = utils.MsgQueue()
     # Initialize Plug-ins Library
     # (Load libraries and modules and init them with Queue `q`)
     slaves = {}
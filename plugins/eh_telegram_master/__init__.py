@@ -2,6 +2,7 @@
 import telegram
 import telegram.ext
 import config
+import queue
 import datetime
 import utils
 import urllib
@@ -11,15 +12,18 @@ import magic
 import os
 import re
 import mimetypes
-import pydub
 import threading
 import traceback
 from . import db, speech
 from .whitelisthandler import WhitelistHandler
-from channel import EFBChannel, EFBMsg, MsgType, MsgSource, TargetType, ChannelType
+from utils import MediaCache, SendScheduler
+from channel import EFBChannel, EFBMsg, EFBMedia, MsgType, MsgSource, TargetType, ChannelType
 from channelExceptions import EFBChatNotFound, EFBMessageTypeNotSupported
 from .msgType import get_msg_type, TGMsgType
-from moviepy.editor import VideoFileClip
+from .transcode import Transcoder
+from .download import DownloadManager, DownloadTooLarge
+from .outbound import OutboundQueue
+from .coalesce import Coalescer
 
 
 class Flags:
@@ -32,6 +36,10 @@ class Flags:
     START_CHOOSE_CHAT = 0x21
     # Command
     COMMAND_PENDING = 0x31
+    # Catch-up
+    CATCH_UP_MEDIA = 0x41
+    # Search
+    SEARCH_RESULTS = 0x51
 
 
 class TelegramChannel(EFBChannel):
@@ -88,6 +96,23 @@ class TelegramChannel(EFBChannel):
             raise ValueError("Token is not properly defined. Please define it in `config.py`.")
         mimetypes.init()
         self.logger = logging.getLogger("plugins.%s.TelegramChannel" % self.channel_id)
+        self.transcoder = Transcoder(self._flag("transcode_workers", 2))
+        self.downloads = DownloadManager(self._flag("download_workers", 4),
+                                         self._flag("max_download_size_mb", 20) * 1024 * 1024)
+        self.outbound = {key: OutboundQueue(key, self._flag("outbound_workers", 2),
+                                            slaves[key].reserve_send, slaves[key].release_send)
+                         for key in slaves}
+        self.send_scheduler = SendScheduler(self._flag("send_rate", 30), self._flag("send_burst", 30),
+                                            self._flag("chat_send_rate", 1), self._flag("chat_send_burst", 3))
+        # Telegram chat ID: [messages waiting to be sent, chat action]
+        self._acks = {}
+        self._ack_lock = threading.Lock()
+        self.coalescer = Coalescer(self._send_text_batch, self._flag("join_msg_window_secs", 2),
+                                   digest_rate=self._flag("digest_threshold_per_min", 60),
+                                   digest_interval=self._flag("digest_interval_secs", 60),
+                                   digest_max=self._flag("digest_max_msgs", 50))
+        self.gif_cache = MediaCache(os.path.join("storage", self.channel_id, "cache"),
+                                    self._flag("media_cache_size_mb", 64) * 1024 * 1024)
         self.me = self.bot.bot.get_me()
         self.bot.dispatcher.add_handler(WhitelistHandler(config.eh_telegram_master['admins']))
         self.bot.dispatcher.add_handler(telegram.ext.CommandHandler("link", self.link_chat_show_list, pass_args=True))
@@ -96,6 +121,7 @@ class TelegramChannel(EFBChannel):
         self.bot.dispatcher.add_handler(telegram.ext.CallbackQueryHandler(self.callback_query_dispatcher))
         self.bot.dispatcher.add_handler(telegram.ext.CommandHandler("start", self.start, pass_args=True))
         self.bot.dispatcher.add_handler(telegram.ext.CommandHandler("extra", self.extra_help))
+        self.bot.dispatcher.add_handler(telegram.ext.CommandHandler("search", self.search, pass_args=True))
         self.bot.dispatcher.add_handler(telegram.ext.RegexHandler(r"^/(?P<id>[0-9]+)_(?P<command>[a-z0-9_-]+)", self.extra_call, pass_groupdict=True))
         self.bot.dispatcher.add_handler(telegram.ext.MessageHandler(
             telegram.ext.Filters.text |
@@ -152,6 +178,10 @@ class TelegramChannel(EFBChannel):
             self.make_chat_head(bot, chat_id, msg_id, text)
         elif msg_status == Flags.COMMAND_PENDING:
             self.command_exec(bot, chat_id, msg_id, text)
+        elif msg_status == Flags.CATCH_UP_MEDIA:
+            self.catch_up_media_exec(bot, chat_id, msg_id, text)
+        elif msg_status == Flags.SEARCH_RESULTS:
+            self.search_page(bot, chat_id, msg_id, text)
         else:
             bot.editMessageText(text="Session expired. Please try again. (SE01)",
                                 chat_id=chat_id,
@@ -178,10 +208,10 @@ class TelegramChannel(EFBChannel):
             xid = datetime.datetime.now().timestamp()
             self.logger.debug("%s, Msg text: %s", xid, msg.text)
             self.logger.debug("%s, process_msg_step_0", xid)
+            media = msg.get_media()
             chat_uid = "%s.%s" % (msg.channel_id, msg.origin['uid'])
             tg_chat = db.get_chat_assoc(slave_uid=chat_uid) or False
             msg_prefix = ""
-            tg_chat_assoced = False
             if not msg.source == MsgSource.Group:
                 msg.member = {"uid": -1, "name": "", "alias": ""}
 
@@ -193,7 +223,6 @@ class TelegramChannel(EFBChannel):
                     msg.member['alias'], msg.member['name'])
             if tg_chat:  # if this chat is linked
                 tg_dest = int(tg_chat.split('.')[1])
-                tg_chat_assoced = True
                 if msg_prefix:  # if group message
                     msg_template = "%s:\n%s" % (msg_prefix, "%s")
                 else:
@@ -211,121 +240,349 @@ class TelegramChannel(EFBChannel):
             elif msg.source == MsgSource.System:
                 msg_template = "System Message: %s"
 
+            # Fetch deferred media
+            if media:
+                max_size = self._flag("max_media_size_mb", 50) * 1024 * 1024
+                if media.size and media.size > max_size:
+                    self.logger.info("%s, media too large to forward: %s bytes", xid, media.size)
+                    msg.text = "%s\n(%s too large to forward: %.1f MiB. (MS04))" % \
+                               (msg.text or "", msg.type, media.size / 1024 / 1024)
+                    msg.type = MsgType.Text
+                else:
+                    media.load()
+                    msg.mime = media.mime or msg.mime
+
             # Type dispatching
             self.logger.debug("%s, process_msg_step_2", xid)
-            append_last_msg = False
             if msg.type in [MsgType.Text, MsgType.Link]:
-                if tg_chat_assoced:
-                    last_msg = db.get_last_msg_from_chat(tg_dest)
-                    if last_msg:
-                        if last_msg.msg_type == "Text":
-                            append_last_msg = str(last_msg.slave_origin_uid) == "%s.%s" % (msg.channel_id, msg.origin['uid'])
-                            if msg.source == MsgSource.Group:
-                                append_last_msg &= str(last_msg.slave_member_uid) == str(msg.member['uid'])
-                            append_last_msg &= datetime.datetime.now() - last_msg.time <= datetime.timedelta(seconds=self._flag('join_msg_threshold_secs', 15))
-                        else:
-                            append_last_msg = False
-                    else:
-                        append_last_msg = False
-                    self.logger.debug("Text: Append last msg: %s", append_last_msg)
-                self.logger.debug("%s, process_msg_step_3_0, tg_dest = %s, tg_chat_assoced = %s, append_last_msg = %s", xid,
-                                  tg_dest, tg_chat_assoced, append_last_msg)
-                if tg_chat_assoced and append_last_msg:
-                    self.logger.debug("%s, process_msg_step_3_0_1", xid)
-                    msg.text = "%s\n%s" % (last_msg.text, msg.text)
-                    tg_msg = self.bot.bot.editMessageText(chat_id=tg_dest,
-                                                          message_id=last_msg.master_msg_id.split(".", 1)[1],
-                                                          text=msg_template % msg.text)
-                else:
-                    self.logger.debug("%s, process_msg_step_3_0_3", xid)
-                    tg_msg = self.bot.bot.sendMessage(tg_dest, text=msg_template % msg.text)
-                    self.logger.debug("%s, process_msg_step_3_0_4, tg_msg = %s", xid, tg_msg)
-                self.logger.debug("%s, process_msg_step_3_1", xid)
-            elif msg.type in [MsgType.Image, MsgType.Sticker]:
+                # Consecutive texts from the same sender are sent together
+                self.logger.debug("%s, process_msg_step_3_0, tg_dest = %s", xid, tg_dest)
+                return self.coalescer.add(tg_dest, (chat_uid, msg.member['uid']), msg_template, msg,
+                                          (msg_prefix or msg.origin['alias']) if tg_chat else None)
+            self.coalescer.flush(tg_dest)
+            if msg.type in [MsgType.Image, MsgType.Sticker]:
                 self.logger.debug("%s, process_msg_step_3_2", xid)
-                self.logger.info("Received %s \nPath: %s\nSize: %s\nMIME: %s", msg.type, msg.path,
-                                 os.stat(msg.path).st_size, msg.mime)
-                if os.stat(msg.path).st_size == 0:
-                    os.remove(msg.path)
-                    return self.bot.bot.sendMessage(tg_dest, msg_template % ("Error: Empty %s received. (MS01)" % msg.type))
+                self.logger.info("Received %s \nName: %s\nSize: %s\nMIME: %s", msg.type, media.name,
+                                 media.size, msg.mime)
+                if media.size == 0:
+                    return self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, msg_template % ("Error: Empty %s received. (MS01)" % msg.type))
                 if not msg.text:
                     if MsgType.Image:
                         msg.text = "sent a picture."
                     elif msg.type == MsgType.Sticker:
                         msg.text = "sent a sticker."
                 if msg.mime == "image/gif":
-                    tg_msg = self.bot.bot.sendDocument(tg_dest, msg.file, caption=msg_template % msg.text)
+                    tg_msg = self._send_media("document", tg_dest, media, media.open,
+                                              caption=msg_template % msg.text)
                 else:
-                    tg_msg = self.bot.bot.sendPhoto(tg_dest, msg.file, caption=msg_template % msg.text)
-                os.remove(msg.path)
+                    tg_msg = self._send_media("photo", tg_dest, media, media.open,
+                                              caption=msg_template % msg.text)
                 self.logger.debug("%s, process_msg_step_3_3", xid)
             elif msg.type == MsgType.File:
-                if os.stat(msg.path).st_size == 0:
-                    os.remove(msg.path)
-                    return self.bot.bot.sendMessage(tg_dest, msg_template % ("Error: Empty %s received. (MS02)" % msg.type))
+                if media.size == 0:
+                    return self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, msg_template % ("Error: Empty %s received. (MS02)" % msg.type))
                 if not msg.text:
-                    file_name = os.path.basename(msg.path)
+                    file_name = media.name
                     msg.text = "sent a file."
                 else:
                     file_name = msg.text
-                tg_msg = self.bot.bot.sendDocument(tg_dest, msg.file, caption=msg_template % msg.text, filename=file_name)
-                os.remove(msg.path)
+                tg_msg = self._send_media("document", tg_dest, media, media.open,
+                                          caption=msg_template % msg.text, filename=file_name)
             elif msg.type == MsgType.Audio:
-                if os.stat(msg.path).st_size == 0:
-                    os.remove(msg.path)
-                    return self.bot.bot.sendMessage(tg_dest, msg_template % ("Error: Empty %s received. (MS03)" % msg.type))
+                if media.size == 0:
+                    return self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, msg_template % ("Error: Empty %s received. (MS03)" % msg.type))
                 msg.text = msg.text or ''
                 self.logger.debug("%s, process_msg_step_4_1, no_conversion = %s", xid, self._flag("no_conversion", False))
                 if self._flag("no_conversion", False):
                     self.logger.debug("%s, process_msg_step_4_2, mime = %s", xid, msg.mime)
                     if msg.mime == "audio/mpeg":
-                        tg_msg = self.bot.bot.sendAudio(tg_dest, msg.file, caption=msg_template % msg.text)
+                        tg_msg = self._tg_call(tg_dest, self.bot.bot.sendAudio, tg_dest, media.open(),
+                                               caption=msg_template % msg.text, priority=1)
                     else:
-                        tg_msg = self.bot.bot.sendDocument(tg_dest, msg.file, caption=msg_template % msg.text)
+                        tg_msg = self._tg_call(tg_dest, self.bot.bot.sendDocument, tg_dest, media.open(),
+                                               caption=msg_template % msg.text, priority=1)
                 else:
-                    pydub.AudioSegment.from_file(msg.file).export("%s.ogg" % msg.path, format="ogg", codec="libopus")
-                    ogg_file = open("%s.ogg" % msg.path, 'rb')
-                    tg_msg = self.bot.bot.sendVoice(tg_dest, ogg_file, caption=msg_template % msg.text)
-                    os.remove("%s.ogg" % msg.path)
-                os.remove(msg.path)
+                    tg_msg = self._send_media("voice", tg_dest, media, lambda: self.transcoder.voice(media.read()),
+                                              caption=msg_template % msg.text)
             elif msg.type == MsgType.Location:
                 self.logger.info("---\nsending venue\nlat: %s, long: %s\ntitle: %s\naddr: %s", msg.attributes['latitude'], msg.attributes['longitude'], msg.text, msg_template % "")
-                tg_msg = self.bot.bot.sendVenue(tg_dest, latitude=msg.attributes['latitude'],
-                                                longitude=msg.attributes['longitude'], title=msg.text,
-                                                address=msg_template % "")
+                tg_msg = self._tg_call(tg_dest, self.bot.bot.sendVenue, tg_dest,
+                                       latitude=msg.attributes['latitude'],
+                                       longitude=msg.attributes['longitude'], title=msg.text,
+                                       address=msg_template % "")
             elif msg.type == MsgType.Video:
-                if os.stat(msg.path).st_size == 0:
-                    os.remove(msg.path)
-                    return self.bot.bot.sendMessage(tg_dest, msg_template % ("Error: Empty %s recieved" % msg.type))
+                if media.size == 0:
+                    return self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, msg_template % ("Error: Empty %s recieved" % msg.type))
                 if not msg.text:
                     msg.text = "sent a video."
-                tg_msg = self.bot.bot.sendVideo(tg_dest, video=msg.file, caption=msg_template % msg.text)
-                os.remove(msg.path)
+                tg_msg = self._send_media("video", tg_dest, media, media.open, caption=msg_template % msg.text)
             elif msg.type == MsgType.Command:
                 buttons = []
                 for i, ival in enumerate(msg.attributes['commands']):
                     buttons.append([telegram.InlineKeyboardButton(ival['name'], callback_data=str(i))])
-                tg_msg = self.bot.bot.send_message(tg_dest, msg_template % msg.text, reply_markup=telegram.InlineKeyboardMarkup(buttons))
+                tg_msg = self._tg_call(tg_dest, self.bot.bot.send_message, tg_dest, msg_template % msg.text, reply_markup=telegram.InlineKeyboardMarkup(buttons))
                 self.msg_status[tg_msg.message_id] = Flags.COMMAND_PENDING
                 self.msg_storage[tg_msg.message_id] = {"channel": msg.channel_id, "text": msg_template % msg.text, "commands": msg.attributes['commands']}
             else:
-                tg_msg = self.bot.bot.sendMessage(tg_dest, msg_template % "Unsupported incoming message type. (UT01)")
+                tg_msg = self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, msg_template % "Unsupported incoming message type. (UT01)")
             self.logger.debug("%s, process_msg_step_4", xid)
-            if msg.source in (MsgSource.User, MsgSource.Group):
-                msg_log = {"master_msg_id": "%s.%s" % (tg_msg.chat.id, tg_msg.message_id),
-                           "text": msg.text,
-                           "msg_type": msg.type,
-                           "sent_to": "Master",
-                           "slave_origin_uid": "%s.%s" % (msg.channel_id, msg.origin['uid']),
-                           "slave_origin_display_name": msg.origin['alias'],
-                           "slave_member_uid": msg.member['uid'],
-                           "slave_member_display_name": msg.member['alias']}
-                if tg_chat_assoced and append_last_msg:
-                    msg_log['update'] = True
-                db.add_msg_log(**msg_log)
+            self._log_msg(tg_msg, msg, msg.text)
             self.logger.debug("%s, process_msg_step_5", xid)
         except Exception as e:
             self.logger.error(repr(e) + traceback.format_exc())
+        finally:
+            if msg.media:
+                msg.media.close()
+            db.release_connection()
+
+    def catch_up(self, msgs):
+        """
+        Deliver a backlog of messages from slave channels in catch-up mode.
+        Messages are grouped by chat, and each chat gets a summary of its
+        messages. Media is not delivered until requested from the buttons
+        under the summary.
+
+        Args:
+            msgs (list of EFBMsg): The messages.
+        """
+        chats = {}
+        for msg in msgs:
+            if msg.source in (MsgSource.User, MsgSource.Group) and msg.type != MsgType.Command:
+                chats.setdefault("%s.%s" % (msg.channel_id, msg.origin['uid']), []).append(msg)
+            else:
+                threading.Thread(target=self.process_msg, args=(msg,)).start()
+        self.logger.info("Catching up %s messages from %s chats.", len(msgs), len(chats))
+        for chat_uid, chat_msgs in chats.items():
+            threading.Thread(target=self.catch_up_chat, args=(chat_uid, chat_msgs)).start()
+
+    def catch_up_chat(self, chat_uid, msgs):
+        """
+        Send a summary of messages from a slave chat.
+
+        Args:
+            chat_uid (str): Slave chat ID ("%(channel_id)s.%(chat_id)s")
+            msgs (list of EFBMsg): Messages from the chat.
+        """
+        try:
+            # The message queue delivers text before media, restore the
+            # order the messages were sent in.
+            msgs = sorted(msgs, key=lambda i: i.time)
+            tg_chat = db.get_chat_assoc(slave_uid=chat_uid)
+            origin = msgs[0].origin
+            if tg_chat:
+                tg_dest = int(tg_chat.split('.')[1])
+                header = "[%s messages while offline]" % len(msgs)
+            else:
+                tg_dest = config.eh_telegram_master['admins'][0]
+                header = "%s%s %s: [%s messages while offline]" % (
+                    msgs[0].channel_emoji, utils.Emojis.get_source_emoji(msgs[0].source),
+                    origin['alias'] if origin['alias'] == origin['name'] else "%s (%s)" % (origin['alias'], origin['name']),
+                    len(msgs))
+            self.coalescer.flush(tg_dest)
+            lines = []
+            media = []
+            for msg in msgs:
+                sender = msg.member['alias'] if msg.source == MsgSource.Group else origin['alias']
+                text = msg.text or ""
+                if msg.get_media() or msg.type == MsgType.Location:
+                    media.append(("%s. %s from %s" % (len(media) + 1, msg.type, sender), msg))
+                    text = "[%s #%s] %s" % (msg.type, len(media), text)
+                text = text.replace("\n", "\n    ")
+                lines.append("%s %s: %s" % (datetime.datetime.fromtimestamp(msg.time).strftime("%H:%M"), sender, text))
+            chunks = [header]
+            for line in lines:
+                if len(chunks[-1]) + len(line) + 1 <= 4096:
+                    chunks[-1] += "\n" + line
+                else:
+                    # Lines longer than a message are split over several.
+                    chunks += [line[i:i + 4096] for i in range(0, len(line), 4096)]
+            # Summaries mix several messages, replies to them go to the chat.
+            for chunk in chunks[:-1]:
+                tg_msg = self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, chunk)
+                self._log_msg(tg_msg, msgs[0], chunk, member=False)
+            # Telegram allows 100 buttons per message.
+            for i in range(0, max(len(media), 1), 90):
+                storage = {"media": {str(n): item for n, item in enumerate(media[i:i + 90], i)}}
+                text = chunks[-1] if i == 0 else "More media:"
+                tg_msg = self._tg_call(tg_dest, self.bot.bot.sendMessage, tg_dest, text,
+                                       reply_markup=self._catch_up_media_markup(storage))
+                self._log_msg(tg_msg, msgs[0], text, member=False)
+                if storage['media']:
+                    self.msg_status[tg_msg.message_id] = Flags.CATCH_UP_MEDIA
+                    self.msg_storage[tg_msg.message_id] = storage
+                    timer = threading.Timer(self._flag("catch_up_media_ttl_secs", 86400), self._expire_catch_up_media,
+                                            args=(tg_dest, tg_msg.message_id, storage))
+                    timer.daemon = True
+                    timer.start()
+        except Exception as e:
+            self.logger.error(repr(e) + traceback.format_exc())
+        finally:
+            db.release_connection()
+
+    @staticmethod
+    def _catch_up_media_markup(storage):
+        """
+        Generate buttons for deferred media of a catch-up summary.
+
+        Args:
+            storage (dict): Deferred media of the summary.
+
+        Returns:
+            telegram.InlineKeyboardMarkup|None: Buttons, `None` if no media is left.
+        """
+        if not storage['media']:
+            return None
+        buttons = [telegram.InlineKeyboardButton(label, callback_data=key)
+                   for key, (label, msg) in sorted(storage['media'].items(), key=lambda i: int(i[0]))]
+        return telegram.InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+
+    def catch_up_media_exec(self, bot, chat_id, msg_id, callback_uid):
+        """
+        Deliver a deferred media message of a catch-up summary.
+
+        Args:
+            bot: Telegram Bot instance
+            chat_id: Chat ID
+            msg_id: Message ID of the summary
+            callback_uid: Key of the media
+        """
+        storage = self.msg_storage.get(msg_id)
+        if not storage:
+            return
+        item = storage['media'].pop(callback_uid, None)
+        if not storage['media']:
+            self.msg_status.pop(msg_id, None)
+            self.msg_storage.pop(msg_id, None)
+        bot.editMessageReplyMarkup(chat_id=chat_id, message_id=msg_id,
+                                   reply_markup=self._catch_up_media_markup(storage))
+        if item:
+            threading.Thread(target=self.process_msg, args=(item[1],)).start()
+
+    def _expire_catch_up_media(self, chat_id, msg_id, storage):
+        """
+        Drop the media not requested from a catch-up summary, and remove
+        its buttons.
+
+        Args:
+            chat_id: Chat ID
+            msg_id: Message ID of the summary
+            storage (dict): Deferred media of the summary
+        """
+        if self.msg_storage.get(msg_id) is not storage:
+            return
+        self.msg_status.pop(msg_id, None)
+        self.msg_storage.pop(msg_id, None)
+        expired = 0
+        while storage['media']:
+            label, msg = storage['media'].popitem()[1]
+            if msg.media:
+                msg.media.close()
+            expired += 1
+        self.logger.debug("%s media of catch-up summary %s.%s expired.", expired, chat_id, msg_id)
+        try:
+            self._tg_call(chat_id, self.bot.bot.editMessageReplyMarkup, chat_id=chat_id, message_id=msg_id,
+                          reply_markup=None, priority=2)
+        except telegram.error.TelegramError as e:
+            self.logger.debug("Failed to remove buttons of catch-up summary %s.%s: %s", chat_id, msg_id, e)
+
+    def _send_text_batch(self, batch):
+        """
+        Send consecutive text messages from the same sender as one message.
+        Called by the coalescer.
+
+        Args:
+            batch (coalesce.TextBatch): The messages.
+        """
+        text = batch.text
+        tg_msg = self._tg_call(batch.chat, self.bot.bot.sendMessage, batch.chat, text=batch.template % text)
+        # Digests mix several senders, replies to them go to the chat.
+        self._log_msg(tg_msg, batch.msgs[0], text, member=not batch.digest)
+
+    @staticmethod
+    def _log_msg(tg_msg, msg, text, member=True):
+        """
+        Add a message delivered to Telegram to the message log.
+
+        Args:
+            tg_msg (telegram.Message): Message sent to Telegram.
+            msg (EFBMsg): The message from slave channel.
+            text (str): Text of the message to be logged.
+            member (bool): Log the sender of `msg`, so that replies quote
+                the message. Otherwise replies are sent to the chat.
+        """
+        if msg.source in (MsgSource.User, MsgSource.Group):
+            db.add_msg_log(master_msg_id="%s.%s" % (tg_msg.chat.id, tg_msg.message_id),
+                           text=text,
+                           msg_type=msg.type,
+                           sent_to="Master",
+                           slave_origin_uid="%s.%s" % (msg.channel_id, msg.origin['uid']),
+                           slave_origin_display_name=msg.origin['alias'],
+                           slave_member_uid=msg.member['uid'] if member else None,
+                           slave_member_display_name=msg.member['alias'] if member else None)
+
+    def _tg_call(self, chat_id, method, *args, priority=0, **kwargs):
+        """
+        Call a send method of the bot within the flood control budgets of
+        Telegram. When Telegram asks to retry later, the chat is paused for
+        the time requested, and the call is retried.
+
+        Args:
+            chat_id (int): Telegram chat ID the call is sent to.
+            method (callable): Method of the bot to call.
+            *args: Arguments of the method.
+            priority (int): Priority of the call, lower values first.
+            **kwargs: Keyword arguments of the method.
+
+        Returns:
+            Result of the method.
+        """
+        retries = self._flag("flood_retries", 5)
+        while True:
+            self.send_scheduler.acquire(chat_id, priority)
+            try:
+                return method(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                if retries <= 0:
+                    raise
+                retries -= 1
+                self.logger.warning("Flood control of chat %s, retry in %s seconds.", chat_id, e.retry_after)
+                self.send_scheduler.pause(chat_id, e.retry_after)
+                for i in list(args) + list(kwargs.values()):
+                    if hasattr(i, "seek"):
+                        i.seek(0)
+
+    def _send_media(self, method, tg_dest, media, get_file, **kwargs):
+        """
+        Send a media file to Telegram, reusing the file ID of an identical
+        file uploaded before instead of uploading it again.
+
+        Args:
+            method (str): Type of media, one of "photo", "document", "video", "voice" or "audio".
+            tg_dest (int): Telegram chat ID
+            media (EFBMedia): Payload of the original file, used to identify the content.
+            get_file (callable): Function returning the file object to upload, only called
+                if the file is not uploaded before.
+            **kwargs: Other parameters passed to the send method.
+
+        Returns:
+            telegram.Message: Message sent
+        """
+        send = getattr(self.bot.bot, "send_%s" % method)
+        file_key = "%s.%s" % (method, media.digest())
+        if kwargs.get("filename"):
+            file_key = "%s.%s" % (file_key, kwargs['filename'])
+        file_id = db.get_file_id(file_key)
+        if file_id:
+            try:
+                return self._tg_call(tg_dest, send, tg_dest, file_id, priority=1, **kwargs)
+            except telegram.error.BadRequest as e:
+                self.logger.info("Cached file ID of %s is rejected, uploading again. (%s)", file_key, e)
+        tg_msg = self._tg_call(tg_dest, send, tg_dest, get_file(), priority=1, **kwargs)
+        attachment = getattr(tg_msg, method)
+        if isinstance(attachment, list):
+            attachment = attachment[-1]
+        db.set_file_id(file_key, attachment.file_id)
+        return tg_msg
 
     def slave_chats_pagination(self, message_id, offset=0, filter=""):
         """
@@ -677,6 +934,88 @@ class TelegramChannel(EFBChannel):
                 msg += "No command found."
         bot.sendMessage(update.message.chat.id, msg, parse_mode="HTML")
 
+    def search(self, bot, update, args=[]):
+        """
+        Search forwarded messages by text. Triggered by `/search`.
+
+        Usage: `/search <query> [chat:<id>]`, where `id` is a Telegram chat
+        ID, or "all" for all chats. In a linked chat, only messages of the
+        chat are searched by default.
+
+        Args:
+            bot: Telegram Bot instance
+            update: Message update
+            args: Arguments from message
+        """
+        chat_id = None
+        if db.get_chat_assoc(master_uid="%s.%s" % (self.channel_id, update.message.chat.id)):
+            chat_id = update.message.chat.id
+        query = []
+        for i in args:
+            m = re.match(r"^chat:(-?[0-9]+|all)$", i)
+            if m:
+                chat_id = None if m.group(1) == "all" else int(m.group(1))
+            else:
+                query.append(i)
+        if not query:
+            return self._reply_error(bot, update, "Usage: /search <query> [chat:<id>|chat:all]")
+        msg_id = bot.sendMessage(update.message.chat.id, "Searching...").message_id
+        self.msg_status[msg_id] = Flags.SEARCH_RESULTS
+        self.msg_storage[msg_id] = {"query": " ".join(query), "chat_id": chat_id, "offset": 0}
+        self.search_page(bot, update.message.chat.id, msg_id)
+
+    def search_page(self, bot, chat_id, message_id, callback_uid=None):
+        """
+        Show a page of search results.
+
+        Args:
+            bot: Telegram Bot instance
+            chat_id: Chat ID
+            message_id: Message ID of the search results
+            callback_uid: "prev" or "next" to turn the page, None for the current page
+        """
+        storage = self.msg_storage[message_id]
+        per_page = self._flag("search_results_per_page", 10)
+        if callback_uid == "next":
+            storage['offset'] += per_page
+        elif callback_uid == "prev":
+            storage['offset'] = max(storage['offset'] - per_page, 0)
+        try:
+            results = db.search_msg_log(storage['query'], storage['chat_id'], storage['offset'], per_page + 1)
+        except Exception as e:
+            self.logger.error("Search failed: %s", repr(e))
+            self.msg_status.pop(message_id, None)
+            self.msg_storage.pop(message_id, None)
+            return bot.editMessageText(text="Search is not available. (SR01)", chat_id=chat_id, message_id=message_id)
+        if not results:
+            txt = "No message found for \"%s\"." % storage['query']
+        else:
+            txt = "Messages found for \"%s\":" % storage['query']
+        for n, i in enumerate(results[:per_page], storage['offset'] + 1):
+            txt += "\n\n%s. [%s] %s:\n%s" % (n, str(i.time)[:16], i.slave_origin_display_name, i.snippet)
+            link = self._msg_link(i.chat_id, i.message_id)
+            if link:
+                txt += "\n%s" % link
+        buttons = []
+        if storage['offset']:
+            buttons.append(telegram.InlineKeyboardButton("< Prev", callback_data="prev"))
+        if len(results) > per_page:
+            buttons.append(telegram.InlineKeyboardButton("Next >", callback_data="next"))
+        bot.editMessageText(text=txt, chat_id=chat_id, message_id=message_id, disable_web_page_preview=True,
+                            reply_markup=telegram.InlineKeyboardMarkup([buttons]) if buttons else None)
+
+    @staticmethod
+    def _msg_link(chat_id, message_id):
+        """
+        Get the link to a message in a Telegram supergroup or channel.
+
+        Returns:
+            str|None: The link, None if the chat does not support links.
+        """
+        if chat_id and str(chat_id).startswith("-100"):
+            return "https://t.me/c/%s/%s" % (str(chat_id)[4:], message_id)
+        return None
+
     def extra_call(self, bot, update, groupdict=None):
         """
         Call an extra function from slave channel.
@@ -729,8 +1068,9 @@ class TelegramChannel(EFBChannel):
         channel, uid = assoc.split('.', 2)
         if channel not in self.slaves:
             return self._reply_error(bot, update, "Internal error: Channel not found.")
+        m = EFBMsg(self)
+        download = None
         try:
-            m = EFBMsg(self)
             mtype = get_msg_type(update.message)
             # Chat and author related stuff
             m.origin['uid'] = update.message.from_user.id
@@ -748,7 +1088,7 @@ class TelegramChannel(EFBChannel):
                 'name': '',
                 'alias': ''
             }
-            if target:
+            if target and targetlog.slave_member_uid:
                 if targetChannel == channel:
                     trgtMsg = EFBMsg(self.slaves[targetChannel])
                     trgtMsg.type = MsgType.Text
@@ -776,43 +1116,46 @@ class TelegramChannel(EFBChannel):
             elif mtype == TGMsgType.Photo:
                 m.type = MsgType.Image
                 m.text = update.message.caption
-                tg_file_id = update.message.photo[-1].file_id
-                m.path, m.mime = self._download_file(update.message, tg_file_id, m.type)
-                m.file = open(m.path, "rb")
+                tg_file = update.message.photo[-1]
+                download = self.downloads.fetch(tg_file.file_id, lambda: self._download_file(
+                    update.message, tg_file.file_id, m.type), tg_file.file_size)
             elif mtype == TGMsgType.Sticker:
                 m.type = MsgType.Sticker
                 m.text = update.message.sticker.emoji
-                tg_file_id = update.message.sticker.file_id
-                m.path, m.mime = self._download_file(update.message, tg_file_id, m.type)
-                m.file = open(m.path, "rb")
+                tg_file = update.message.sticker
+                download = self.downloads.fetch(tg_file.file_id, lambda: self._download_file(
+                    update.message, tg_file.file_id, m.type), tg_file.file_size)
             elif mtype == TGMsgType.Document:
                 m.text = update.message.document.file_name
-                tg_file_id = update.message.document.file_id
+                tg_file = update.message.document
                 self.logger.debug("tg: Document file received")
-                if update.message.document.mime_type == "video/mp4":
+                if tg_file.mime_type == "video/mp4":
                     self.logger.debug("tg: GIF received")
                     m.type = MsgType.Image
-                    m.path, m.mime = self._download_gif(update.message, tg_file_id, m.type)
+                    download = self.downloads.fetch("gif.%s" % tg_file.file_id, lambda: self._download_gif(
+                        update.message, tg_file.file_id, m.type), tg_file.file_size)
                 else:
                     m.type = MsgType.File
-                    m.path, m.mime = self._download_file(update.message, tg_file_id, m.type)
-                m.file = open(m.path, "rb")
+                    download = self.downloads.fetch(tg_file.file_id, lambda: self._download_file(
+                        update.message, tg_file.file_id, m.type, tg_file.file_name), tg_file.file_size)
             elif mtype == TGMsgType.Video:
                 m.type = MsgType.Video
                 m.text = update.message.document.file_name
-                tg_file_id = update.message.document.file_id
-                m.path, m.mime = self._download_file(update.message, tg_file_id, m.type)
-                m.file = open(m.path, "rb")
+                tg_file = update.message.document
+                download = self.downloads.fetch(tg_file.file_id, lambda: self._download_file(
+                    update.message, tg_file.file_id, m.type), tg_file.file_size)
             elif mtype == TGMsgType.Audio:
                 m.type = MsgType.Audio
                 m.text = "%s - %s" % (update.message.audio.title, update.message.audio.perfomer)
-                tg_file_id = update.message.audio.file_id
-                m.path, m.mime = self._download_file(update.message, tg_file_id, m.type)
+                tg_file = update.message.audio
+                download = self.downloads.fetch(tg_file.file_id, lambda: self._download_file(
+                    update.message, tg_file.file_id, m.type), tg_file.file_size)
             elif mtype == TGMsgType.Voice:
                 m.type = MsgType.Audio
                 m.text = ""
-                tg_file_id = update.message.voice.file_id
-                m.path, m.mime = self._download_file(update.message, tg_file_id, m.type)
+                tg_file = update.message.voice
+                download = self.downloads.fetch(tg_file.file_id, lambda: self._download_file(
+                    update.message, tg_file.file_id, m.type), tg_file.file_size)
             elif mtype == TGMsgType.Location:
                 m.type = MsgType.Location
                 m.text = "Location"
@@ -829,14 +1172,102 @@ class TelegramChannel(EFBChannel):
                 }
             else:
                 return self._reply_error(bot, update, "Message type not supported. (MN02)")
+        except EFBChatNotFound:
+            return self._reply_error(bot, update, "Internal error: Chat not found in channel. (CN01)")
+
+        # Delivered by the outbound queue of the slave channel, in order per
+        # chat, without holding up the dispatcher for downloads and uploads.
+        self.outbound[channel].put(uid, self._send_to_slave, bot, update, channel, m, download,
+                                   priority=0 if m.type == MsgType.Text else 1)
+        # Acknowledged with a chat action until sent, errors are replied.
+        self._acknowledge(update.message.chat.id, {
+            MsgType.Image: telegram.ChatAction.UPLOAD_PHOTO,
+            MsgType.Sticker: telegram.ChatAction.UPLOAD_PHOTO,
+            MsgType.Video: telegram.ChatAction.UPLOAD_VIDEO,
+            MsgType.Audio: telegram.ChatAction.UPLOAD_AUDIO,
+            MsgType.File: telegram.ChatAction.UPLOAD_DOCUMENT}.get(m.type, telegram.ChatAction.TYPING))
+
+    def _acknowledge(self, chat_id, action):
+        """
+        Show a chat action in a Telegram chat while messages from it are
+        waiting in the outbound queue or being sent. The action is renewed
+        before it expires, until `_acknowledged` is called for each message.
+
+        Args:
+            chat_id (int): Telegram chat ID
+            action (str): Chat action, of the latest message
+        """
+        with self._ack_lock:
+            ack = self._acks.get(chat_id)
+            if ack:
+                ack[0] += 1
+                ack[1] = action
+                return
+            self._acks[chat_id] = [1, action]
+        threading.Thread(target=self._ack_loop, args=(chat_id,), daemon=True).start()
+
+    def _acknowledged(self, chat_id):
+        """
+        Mark a message from a Telegram chat as sent or failed.
+
+        Args:
+            chat_id (int): Telegram chat ID
+        """
+        with self._ack_lock:
+            ack = self._acks.get(chat_id)
+            if ack:
+                ack[0] -= 1
+
+    def _ack_loop(self, chat_id):
+        while True:
+            with self._ack_lock:
+                count, action = self._acks[chat_id]
+                if count <= 0:
+                    del self._acks[chat_id]
+                    return
+            try:
+                # Lowest priority, behind messages from slave channels.
+                self._tg_call(chat_id, self.bot.bot.sendChatAction, chat_id, action, priority=2)
+            except telegram.error.TelegramError as e:
+                self.logger.debug("Failed to send chat action to %s: %s", chat_id, e)
+            # Chat actions expire after 5 seconds.
+            time.sleep(4)
+
+    def _send_to_slave(self, bot, update, channel, m, download=None):
+        """
+        Send a message from Telegram to the slave channel.
+        Run by the outbound queue, errors are replied to the original message.
 
+        Args:
+            bot: Telegram Bot instance
+            update: Message update
+            channel (str): Slave channel ID
+            m (EFBMsg): Message to send
+            download (concurrent.futures.Future): Future of the media of the message, if any
+        """
+        try:
+            if download:
+                try:
+                    m.media = download.result()
+                except DownloadTooLarge:
+                    return self._reply_error(bot, update, "File is too large to be downloaded. (DL01)")
+                except Exception:
+                    return self._reply_error(bot, update, "Failed to download the file. (DL02)")
+                m.mime = m.media.mime
             self.slaves[channel].send_message(m)
         except EFBChatNotFound:
             return self._reply_error(bot, update, "Internal error: Chat not found in channel. (CN01)")
         except EFBMessageTypeNotSupported:
             return self._reply_error(bot, update, "Message type not supported. (MN01)")
-
-    def _download_file(self, tg_msg, file_id, msg_type):
+        except Exception as e:
+            self.logger.exception("Failed to send message to %s.", channel)
+            return self._reply_error(bot, update, "Failed to send message: %s (OB01)" % e)
+        finally:
+            if m.media:
+                m.media.close()
+            self._acknowledged(update.message.chat.id)
+
+    def _download_file(self, tg_msg, file_id, msg_type, file_name=None):
         """
         Download media file from telegram platform.
 
@@ -844,28 +1275,28 @@ class TelegramChannel(EFBChannel):
             tg_msg: Telegram message instance
             file_id: File ID
             msg_type: Type of message
+            file_name: File name of the media, generated from the message if omitted
 
         Returns:
-            tuple of str[2]: Full path of the file, MIME type
+            EFBMedia: Payload of the file
         """
-        path = os.path.join("storage", self.channel_id)
-        if not os.path.exists(path):
-            os.makedirs(path)
+        media = EFBMedia(name=file_name or os.path.basename(self._storage_path(tg_msg, msg_type)),
+                         spool_dir=os.path.join("storage", self.channel_id))
         f = self.bot.bot.getFile(file_id)
-        fname = "%s_%s_%s_%s" % (msg_type, tg_msg.chat.id, tg_msg.message_id, int(time.time()))
-        fullpath = os.path.join(path, fname)
-        f.download(fullpath)
-        mime = magic.from_file(fullpath, mime=True)
+        f.download(out=media)
+        mime = magic.from_buffer(media.read(2048), mime=True)
         if type(mime) is bytes:
             mime = mime.decode()
-        ext = mimetypes.guess_extension(mime)
-        os.rename(fullpath, "%s.%s" % (fullpath, ext))
-        fullpath = "%s.%s" % (fullpath, ext)
-        return fullpath, mime
+        media.mime = mime
+        if not file_name:
+            media.name += mimetypes.guess_extension(mime) or ""
+        return media
 
     def _download_gif(self, tg_msg, file_id, msg_type):
         """
         Download and convert GIF image.
+        Converted GIFs are cached by file ID, so that a repeated GIF is
+        neither downloaded nor converted again.
 
         Args:
             tg_msg: Telegram message instance
@@ -873,11 +1304,35 @@ class TelegramChannel(EFBChannel):
             msg_type: Type of message
 
         Returns:
-            tuple of str[2]: Full path of the file, MIME type
+            EFBMedia: Payload of the GIF image
+        """
+        cache_key = "gif.%s" % file_id
+        gif_path = "%s.gif" % self._storage_path(tg_msg, msg_type)
+        if self.gif_cache.get(cache_key, gif_path):
+            self.logger.debug("Converted GIF found in cache: %s", gif_path)
+        else:
+            with self._download_file(tg_msg, file_id, msg_type) as media:
+                self.transcoder.gif(media.path, gif_path,
+                                    max_size=self._flag("gif_max_size", 480), max_fps=self._flag("gif_max_fps", 15))
+            self.gif_cache.put(cache_key, gif_path)
+        return EFBMedia.from_path(gif_path, "image/gif")
+
+    def _storage_path(self, tg_msg, msg_type):
+        """
+        Generate a path in the local storage for a media file of a message.
+
+        Args:
+            tg_msg: Telegram message instance
+            msg_type: Type of message
+
+        Returns:
+            str: Full path of the file, without extension
         """
-        fullpath, mime = self._download_file(tg_msg, file_id, msg_type)
-        VideoFileClip(fullpath).write_gif(fullpath + ".gif", program="ffmpeg")
-        return fullpath + ".gif", "image/gif"
+        path = os.path.join("storage", self.channel_id)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        fname = "%s_%s_%s_%s" % (msg_type, tg_msg.chat.id, tg_msg.message_id, int(time.time()))
+        return os.path.join(path, fname)
 
     def start(self, bot, update, args=[]):
         """
@@ -955,7 +1410,8 @@ class TelegramChannel(EFBChannel):
             return self._reply_error(bot, update, "Language is not supported. Try with zh, ja or en. (RS03)")
         if update.message.reply_to_message.voice.duration > 60:
             return self._reply_error(bot, update, "Only voice shorter than 60s is supported. (RS04)")
-        path, mime = self._download_file(update.message, update.message.reply_to_message.voice.file_id, MsgType.Audio)
+        media = self._download_file(update.message, update.message.reply_to_message.voice.file_id, MsgType.Audio)
+        path = media.path
 
         results = {}
         if len(args) == 0:
@@ -992,18 +1448,36 @@ class TelegramChannel(EFBChannel):
         bot.sendMessage(update.message.reply_to_message.chat.id, msg,
                         reply_to_message_id=update.message.reply_to_message.message_id,
                         parse_mode=telegram.ParseMode.MARKDOWN)
-        os.remove(path)
+        media.close()
 
     def poll(self):
         """
         Message polling process.
         """
         self.bot.start_polling(network_delay=10, timeout=10)
+        # Messages are taken from the queue only when a delivery slot is
+        # free, so that while all slots are busy, e.g. with large media,
+        # the lanes of the queue decide what is delivered next.
+        slots = threading.BoundedSemaphore(self._flag("delivery_workers", 4))
         while True:
             try:
+                slots.acquire()
                 m = self.queue.get()
                 self.logger.info("Got message from queue\nType: %s\nText: %s\n----" % (m.type, m.text))
-                threading.Thread(target=self.process_msg, args=(m,)).start()
+                if self.queue.qsize() >= self._flag("catch_up_queue_size", 50) or \
+                        time.time() - m.time >= self._flag("catch_up_age_secs", 300):
+                    # Backlog after reconnection, summarize everything pending.
+                    msgs = [m]
+                    try:
+                        while True:
+                            msgs.append(self.queue.get_nowait())
+                            self.queue.task_done()
+                    except queue.Empty:
+                        pass
+                    self.catch_up(msgs)
+                    slots.release()
+                else:
+                    threading.Thread(target=self._deliver, args=(m, slots)).start()
                 self.queue.task_done()
                 self.logger.info("Msg sent to TG, task_done marked.")
             except Exception as e:
@@ -1012,6 +1486,19 @@ class TelegramChannel(EFBChannel):
                 self.bot.stop()
                 self.poll()
 
+    def _deliver(self, msg, slots):
+        """
+        Deliver a message from the queue, and free its delivery slot.
+
+        Args:
+            msg (EFBMsg): The message.
+            slots (threading.BoundedSemaphore): Delivery slots.
+        """
+        try:
+            self.process_msg(msg)
+        finally:
+            slots.release()
+
     def error(self, bot, update, error):
         """
         Print error to console, Triggered by python-telegram-bot error callback.
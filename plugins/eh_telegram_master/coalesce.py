@@ -0,0 +1,183 @@
+import time
+import logging
+import threading
+from collections import deque
+
+
+class TextBatch:
+    """
+    Consecutive text messages from the same sender to be sent as one,
+    or a digest of text messages from a chat.
+
+    Attributes:
+        chat (int): Telegram chat ID to send to.
+        sender (tuple): Identifier of the sender, `None` for digests.
+        template (str): Message template, with "%s" in place of the text.
+        msgs (list of EFBMsg): Messages in the batch.
+        names (list of str): Display names of the senders of the messages, for digests.
+    """
+
+    def __init__(self, chat, sender, template, msg, name=None):
+        self.chat = chat
+        self.sender = sender
+        self.template = template
+        self.msgs = [msg]
+        self.names = [name]
+        self.timer = None
+
+    @property
+    def digest(self):
+        """bool: If the batch is a digest."""
+        return self.sender is None
+
+    def render(self, msgs, names):
+        if not self.digest:
+            return "\n".join(i.text or "" for i in msgs)
+        lines = ["[Digest of %s messages]" % len(msgs)]
+        last = None
+        for name, msg in zip(names, msgs):
+            for n, line in enumerate((msg.text or "").split("\n")):
+                if n or name == last:
+                    lines.append("  %s" % line)
+                else:
+                    lines.append("%s: %s" % (name, line))
+            last = name
+        return "\n".join(lines)
+
+    @property
+    def text(self):
+        """str: Text of the batch."""
+        return self.render(self.msgs, self.names)
+
+    def fits(self, msg, name, limit):
+        """
+        Check if a message can be added without exceeding the length limit.
+
+        Returns:
+            bool: `True` if the message fits in the batch.
+        """
+        return len(self.template % self.render(self.msgs + [msg], self.names + [name])) <= limit
+
+
+class Coalescer:
+    """
+    Buffer consecutive text messages from the same sender in a chat for
+    a short window, so that a burst is sent as a single message.
+
+    A batch is sent when the window since its first message is over, when
+    a message from another sender or of another type comes to the chat, or
+    when the next text would make it longer than `limit`.
+
+    Chats receiving more than `digest_rate` messages per minute switch to
+    digest mode, where texts from all senders are collected for
+    `digest_interval` seconds or up to `digest_max` messages, and sent as a
+    digest. Messages of other types do not interrupt a digest. The chat
+    leaves digest mode when its rate drops to half of `digest_rate`.
+
+    Args:
+        send (callable): Function sending a `TextBatch`.
+        window (float): Time in seconds to buffer a batch.
+        limit (int): Maximum length of the text of a batch.
+        digest_rate (int): Messages per minute to switch a chat to digest mode, 0 to disable.
+        digest_interval (float): Time in seconds to collect a digest.
+        digest_max (int): Maximum number of messages in a digest.
+    """
+
+    def __init__(self, send, window=2, limit=4096, digest_rate=0, digest_interval=60, digest_max=50):
+        self.send = send
+        self.window = window
+        self.limit = limit
+        self.digest_rate = digest_rate
+        self.digest_interval = digest_interval
+        self.digest_max = digest_max
+        self.logger = logging.getLogger("plugins.eh_telegram_master.coalesce")
+        self._batches = {}
+        self._rates = {}
+        self._digests = set()
+        self._lock = threading.Lock()
+
+    def _in_digest(self, chat):
+        """
+        Record a message to a chat, and check if the chat is in digest mode.
+        """
+        if not self.digest_rate:
+            return False
+        now = time.monotonic()
+        rate = self._rates.setdefault(chat, deque())
+        rate.append(now)
+        while rate[0] < now - 60:
+            rate.popleft()
+        if chat not in self._digests and len(rate) > self.digest_rate:
+            self.logger.info("Chat %s switched to digest mode at %s messages per minute.", chat, len(rate))
+            self._digests.add(chat)
+        elif chat in self._digests and len(rate) <= self.digest_rate / 2:
+            self.logger.info("Chat %s left digest mode.", chat)
+            self._digests.discard(chat)
+        return chat in self._digests
+
+    def add(self, chat, sender, template, msg, name=None):
+        """
+        Add a text message to the batch of a chat.
+
+        Args:
+            chat (int): Telegram chat ID to send to.
+            sender (tuple): Identifier of the sender.
+            template (str): Message template, with "%s" in place of the text.
+            msg (EFBMsg): The message.
+            name (str): Display name of the sender for digests, `None` if
+                the chat should not switch to digest mode.
+        """
+        with self._lock:
+            batch = self._batches.get(chat)
+            window = self.window
+            if name is not None and self._in_digest(chat):
+                sender, template, window = None, "%s", self.digest_interval
+                if batch and batch.digest and len(batch.msgs) < self.digest_max and \
+                        batch.fits(msg, name, self.limit):
+                    batch.msgs.append(msg)
+                    batch.names.append(name)
+                    return
+            elif batch and batch.sender == sender and batch.template == template and \
+                    batch.fits(msg, name, self.limit):
+                batch.msgs.append(msg)
+                batch.names.append(name)
+                return
+            self._batches.pop(chat, None)
+            new = self._batches[chat] = TextBatch(chat, sender, template, msg, name)
+            new.timer = threading.Timer(window, self._expire, args=(new,))
+            new.timer.daemon = True
+            new.timer.start()
+        if batch:
+            self._send(batch)
+
+    def flush(self, chat):
+        """
+        Send the pending batch of a chat, if any, before another message
+        is sent to it. Digests are not affected.
+
+        Args:
+            chat (int): Telegram chat ID.
+        """
+        with self._lock:
+            batch = self._batches.get(chat)
+            if batch and batch.digest:
+                return
+            batch = self._batches.pop(chat, None)
+        if batch:
+            self._send(batch)
+
+    def _expire(self, batch):
+        with self._lock:
+            if self._batches.get(batch.chat) is not batch:
+                return
+            del self._batches[batch.chat]
+        self._send(batch)
+
+    def _send(self, batch):
+        batch.timer.cancel()
+        if len(batch.msgs) > 1:
+            self.logger.debug("Sending %s messages to %s as one.", len(batch.msgs), batch.chat)
+        try:
+            self.send(batch)
+        except Exception:
+            self.logger.exception("Failed to send batch of messages to %s.", batch.chat)
@@ -1,15 +1,195 @@
 import os
+import time
+import glob
+import atexit
+import config
+import sqlite3
 import inspect
 import logging
 import datetime
+import threading
+from collections import OrderedDict, namedtuple
 from peewee import *
 from playhouse.migrate import *
 
 basePath = os.path.dirname(os.path.abspath(inspect.stack()[0][1]))
-
-db = SqliteDatabase(basePath + '/tgdata.db')
 logger = logging.getLogger("plugins.eh_telegram_master.db")
 
+
+def _flag(key, value):
+    """
+    Retrieve value for experimental flags of ETM.
+
+    Args:
+        key: Key of the flag.
+        value: Default/fallback value.
+
+    Returns:
+        Value for the flag.
+    """
+    return config.eh_telegram_master.get('flags', dict()).get(key, value)
+
+
+# WAL journal lets reads go on while a write is in progress, and busy
+# timeout makes writers wait for each other instead of failing with
+# "database is locked". Each thread opens its own connection, which
+# short-lived threads close with `release_connection`.
+db = SqliteDatabase(basePath + '/tgdata.db',
+                    timeout=_flag("db_busy_timeout_secs", 30),
+                    pragmas=(('journal_mode', 'wal'),
+                             ('synchronous', 'normal'),
+                             ('cache_size', -8192),
+                             # Fire delete triggers on INSERT OR REPLACE, to keep the search index in sync.
+                             ('recursive_triggers', 'on')))
+
+
+def release_connection():
+    """
+    Close the database connection of the current thread.
+    To be called when a short-lived thread has finished using the database.
+    """
+    if not db.is_closed():
+        db.close()
+
+
+class _LRUCache:
+    """
+    Thread-safe in-memory LRU cache, counting hits and misses.
+
+    `None` is a valid value, used for negative entries.
+
+    Args:
+        max_size (int): Maximum number of entries.
+    """
+    _missing = object()
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (bool: if `key` is cached, cached value)
+        """
+        with self._lock:
+            value = self._entries.get(key, self._missing)
+            if value is self._missing:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return True, value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value):
+        """
+        Cache `value` only if `key` is not cached, e.g. for values read
+        from the database, which may be older than a concurrent `put`.
+        """
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of `entries`, `hits` and `misses`.
+        """
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Caches of chat associations, master UID to slave UID and reverse.
+# Writes go through to the database and the caches under `_assoc_lock`.
+_master_assoc_cache = _LRUCache(1024)
+_slave_assoc_cache = _LRUCache(1024)
+_assoc_lock = threading.RLock()
+# Cache of recent message log entries by master_msg_id, for reply resolution.
+_msg_log_cache = _LRUCache(_flag("msg_log_cache_size", 4096))
+
+
+class _MsgLogWriter:
+    """
+    Write-behind writer of message log entries.
+
+    Entries are kept in memory and written in batches by a background
+    thread, in one transaction per batch, every `interval` seconds or
+    when `batch_size` entries are pending. Pending entries are visible to
+    lookups through `get`.
+
+    Args:
+        interval (float): Time in seconds between writes.
+        batch_size (int): Number of pending entries to write immediately.
+    """
+
+    def __init__(self, interval=1, batch_size=200):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._event = threading.Event()
+        threading.Thread(target=self._run, name="MsgLogWriter", daemon=True).start()
+
+    def put(self, row):
+        """
+        Queue an entry to be written.
+
+        Args:
+            row (MsgLogRow): The entry.
+        """
+        with self._lock:
+            self.pending.pop(row.master_msg_id, None)
+            self.pending[row.master_msg_id] = row
+            if len(self.pending) >= self.batch_size:
+                self._event.set()
+
+    def get(self, master_msg_id):
+        """
+        Returns:
+            MsgLogRow|None: The pending entry, `None` if not pending.
+        """
+        with self._lock:
+            return self.pending.get(master_msg_id)
+
+    def flush(self):
+        """Write all pending entries to the database."""
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self.pending.values())
+            if not rows:
+                return
+            with db.atomic():
+                for row in rows:
+                    _put_msg_log(row)
+            with self._lock:
+                for row in rows:
+                    if self.pending.get(row.master_msg_id) is row:
+                        del self.pending[row.master_msg_id]
+            logger.debug("%s message log entries written.", len(rows))
+
+    def _run(self):
+        while True:
+            self._event.wait(self.interval)
+            self._event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write message log.")
+
+
 # Peewee Models
 
 class BaseModel(Model):
@@ -33,32 +213,408 @@ class MsgLog(BaseModel):
     msg_type = CharField()
     sent_to = CharField()
     time = DateTimeField(default=datetime.datetime.now, null=True)
+    chat_id = BigIntegerField(null=True)
+    message_id = BigIntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (('chat_id', 'time'), False),
+        )
+
+
+# Fast path of hot queries: constant SQL statements, so that SQLite reuses
+# the prepared statements cached on each connection, and plain tuples
+# instead of model instances for message log entries.
+
+_MSG_LOG_COLUMNS = ("master_msg_id", "text", "slave_origin_uid", "slave_origin_display_name",
+                    "slave_member_uid", "slave_member_display_name", "msg_type", "sent_to",
+                    "time", "chat_id", "message_id")
+MsgLogRow = namedtuple("MsgLogRow", _MSG_LOG_COLUMNS)
+MsgLogSearchResult = namedtuple("MsgLogSearchResult", _MSG_LOG_COLUMNS + ("snippet",))
+
+_SQL_GET_SLAVE_UID = "SELECT slave_uid FROM chatassoc WHERE master_uid = ? LIMIT 1"
+_SQL_GET_MASTER_UID = "SELECT master_uid FROM chatassoc WHERE slave_uid = ? LIMIT 1"
+_SQL_SELECT_MSG_LOG = "SELECT %s FROM msglog" % ", ".join(_MSG_LOG_COLUMNS)
+_SQL_GET_MSG_LOG = _SQL_SELECT_MSG_LOG + " WHERE master_msg_id = ?"
+_SQL_PUT_MSG_LOG = "INSERT OR REPLACE INTO msglog (%s) VALUES (%s)" % (
+    ", ".join(_MSG_LOG_COLUMNS), ", ".join("?" * len(_MSG_LOG_COLUMNS)))
+_SQL_SEARCH_MSG_LOG = "SELECT %s, snippet(msglog_fts, 0, '', '', '...', 16) " \
+                      "FROM msglog_fts JOIN msglog ON msglog.rowid = msglog_fts.rowid " \
+                      "WHERE msglog_fts MATCH ?" % ", ".join("msglog.%s" % i for i in _MSG_LOG_COLUMNS)
+
+
+def _parse_time(value):
+    if isinstance(value, str):
+        for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+    return value
+
+
+def _msg_log_row(values):
+    """
+    Build a message log entry from a row of `_SQL_SELECT_MSG_LOG`.
+
+    Returns:
+        MsgLogRow|None: The entry, None if `values` is None.
+    """
+    if values is None:
+        return None
+    row = MsgLogRow(*values)
+    return row._replace(time=_parse_time(row.time))
+
+
+def _put_msg_log(row):
+    db.execute_sql(_SQL_PUT_MSG_LOG, row._replace(time=str(row.time) if row.time else None))
+
+
+class FileIdCache(BaseModel):
+    file_key = CharField(unique=True, primary_key=True)
+    file_id = CharField()
+    time = DateTimeField(default=datetime.datetime.now)
+
+
+class _MsgLogPruner:
+    """
+    Background pruning of expired message log entries.
+
+    Entries older than `max_age` days, and entries beyond the latest
+    `max_count` of each chat, are removed in small batches. If `archive`
+    is enabled, removed entries are moved to monthly archive databases in
+    `archive/msglog-YYYY-MM.db`, where `get_msg_log` can still find them.
+
+    Space freed is reused by SQLite for new entries. If `vacuum` is
+    enabled, it is returned to the file system by incremental vacuum,
+    which requires `enable_vacuum` to be called once on start.
+
+    Args:
+        max_age (int): Retention in days, 0 to keep all.
+        max_count (int): Entries to keep per chat, 0 to keep all.
+        archive (bool): If removed entries are archived.
+        vacuum (bool): If freed space is returned to the file system.
+        interval (float): Time in seconds between prunes.
+        batch_size (int): Entries removed per transaction.
+    """
+    archive_path = os.path.join(basePath, "archive")
+
+    def __init__(self, max_age=0, max_count=0, archive=False, vacuum=False, interval=3600, batch_size=500):
+        self.max_age = max_age
+        self.max_count = max_count
+        self.archive = archive
+        self.vacuum = vacuum
+        self.interval = interval
+        self.batch_size = batch_size
+        threading.Thread(target=self._run, name="MsgLogPruner", daemon=True).start()
+
+    @classmethod
+    def find_archived(cls, master_msg_id):
+        """
+        Find a message log entry in the archives, latest month first.
+
+        Args:
+            master_msg_id (str): Telegram message ID ("%(chat_id)s.%(msg_id)s")
+
+        Returns:
+            MsgLogRow|None: The archived entry, None if not found.
+        """
+        for path in sorted(glob.glob(os.path.join(cls.archive_path, "msglog-*.db")), reverse=True):
+            conn = sqlite3.connect(path)
+            try:
+                conn.row_factory = sqlite3.Row
+                row = conn.execute("SELECT * FROM msglog WHERE master_msg_id = ?", (master_msg_id,)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                return _msg_log_row([row[k] if k in row.keys() else None for k in _MSG_LOG_COLUMNS])
+        return None
+
+    def _archive(self, month, rowids):
+        os.makedirs(self.archive_path, exist_ok=True)
+        db.execute_sql("ATTACH DATABASE ? AS archive",
+                       (os.path.join(self.archive_path, "msglog-%s.db" % month),))
+        try:
+            db.execute_sql("CREATE TABLE IF NOT EXISTS archive.msglog AS SELECT * FROM main.msglog WHERE 0")
+            db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS archive.msglog_master_msg_id ON msglog (master_msg_id)")
+            archived = [i[1] for i in db.execute_sql("PRAGMA archive.table_info(msglog)").fetchall()]
+            columns = ", ".join(i for i in _columns("msglog") if i in archived)
+            db.execute_sql("INSERT OR REPLACE INTO archive.msglog (%s) SELECT %s FROM main.msglog WHERE rowid IN (%s)" %
+                           (columns, columns, ", ".join("?" * len(rowids))), rowids)
+        finally:
+            db.execute_sql("DETACH DATABASE archive")
+
+    def _remove(self, rows):
+        """
+        Remove a batch of entries.
+
+        Args:
+            rows (list of tuple): `rowid` and `time` of entries to remove.
+        """
+        rowids = [i[0] for i in rows]
+        if self.archive:
+            months = {}
+            for rowid, t in rows:
+                months.setdefault(str(t or "")[:7] or "unknown", []).append(rowid)
+            for month, ids in months.items():
+                self._archive(month, ids)
+        with db.atomic():
+            db.execute_sql("DELETE FROM msglog WHERE rowid IN (%s)" % ", ".join("?" * len(rowids)), rowids)
+
+    def prune(self):
+        """
+        Remove all expired entries.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        removed = 0
+        if self.max_age:
+            cutoff = str(datetime.datetime.now() - datetime.timedelta(days=self.max_age))
+            # `time` is not indexed, walk the table in order of rowid from
+            # the last batch, so that the table is scanned only once.
+            last = 0
+            while True:
+                rows = db.execute_sql("SELECT rowid, time FROM msglog WHERE rowid > ? AND time < ? "
+                                      "ORDER BY rowid LIMIT %d" % self.batch_size, (last, cutoff)).fetchall()
+                if rows:
+                    last = rows[-1][0]
+                    self._remove(rows)
+                    removed += len(rows)
+                if len(rows) < self.batch_size:
+                    break
+                time.sleep(0.1)
+        if self.max_count:
+            chats = db.execute_sql("SELECT chat_id FROM msglog GROUP BY chat_id HAVING COUNT(*) > ?",
+                                   (self.max_count,)).fetchall()
+            for chat_id, in chats:
+                while True:
+                    rows = db.execute_sql("SELECT rowid, time FROM msglog WHERE chat_id = ? "
+                                          "ORDER BY time DESC LIMIT %d OFFSET %d" % (self.batch_size, self.max_count),
+                                          (chat_id,)).fetchall()
+                    if rows:
+                        self._remove(rows)
+                        removed += len(rows)
+                    if len(rows) < self.batch_size:
+                        break
+                    time.sleep(0.1)
+        if removed:
+            if self.vacuum:
+                db.execute_sql("PRAGMA incremental_vacuum")
+            logger.info("%s expired message log entries removed.", removed)
+        return removed
+
+    @staticmethod
+    def enable_vacuum():
+        """
+        Enable incremental vacuum of the database, if not yet enabled.
+
+        On an existing database, this runs a full `VACUUM`, which locks the
+        database until finished. To be called on start, before the database
+        is used.
+        """
+        try:
+            if db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                logger.info("Enabling incremental vacuum of the database, this may take a while.")
+                db.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+                db.execute_sql("VACUUM")
+        except Exception:
+            logger.exception("Failed to enable incremental vacuum.")
+
+    def _run(self):
+        while True:
+            try:
+                self.prune()
+            except Exception:
+                logger.exception("Failed to prune message log.")
+            time.sleep(self.interval)
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    description = CharField()
+    time = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        db_table = "schema_version"
+        table_name = "schema_version"
 
 
 def _create():
     """
     Initializing tables.
     """
-    db.create_tables([ChatAssoc, MsgLog])
+    db.create_tables([ChatAssoc, MsgLog, FileIdCache, SchemaVersion])
+    _create_search_index()
 
 
-def _migrate(i):
+def _create_search_index():
     """
-    Run migrations.
+    Create the full-text search index of message log, kept in sync by triggers.
 
-    Args:
-        i: Migration ID
+    Rows in the range recorded in `msglog_fts_backfill` (`done` < rowid <=
+    `last`) are not indexed yet, and are skipped by the triggers until
+    they are indexed by the migration. Removing rows that are not indexed
+    from the index would corrupt it.
 
     Returns:
-        False: when migration ID is not found
+        bool: If the index is created, `False` if FTS5 is not available in SQLite.
+    """
+    try:
+        db.execute_sql("CREATE VIRTUAL TABLE IF NOT EXISTS msglog_fts USING fts5("
+                       "text, content='msglog', content_rowid='rowid')")
+    except OperationalError as e:
+        logger.warning("Full-text search of message log is not available: %s", e)
+        return False
+    db.execute_sql("CREATE TABLE IF NOT EXISTS msglog_fts_backfill (done INTEGER, last INTEGER)")
+    indexed = "NOT EXISTS (SELECT 1 FROM msglog_fts_backfill WHERE %s.rowid > done AND %s.rowid <= last)"
+    db.execute_sql("CREATE TRIGGER IF NOT EXISTS msglog_fts_insert AFTER INSERT ON msglog WHEN %s BEGIN "
+                   "INSERT INTO msglog_fts(rowid, text) VALUES (new.rowid, new.text); END" % (indexed % ("new", "new")))
+    db.execute_sql("CREATE TRIGGER IF NOT EXISTS msglog_fts_delete AFTER DELETE ON msglog WHEN %s BEGIN "
+                   "INSERT INTO msglog_fts(msglog_fts, rowid, text) VALUES ('delete', old.rowid, old.text); END"
+                   % (indexed % ("old", "old")))
+    db.execute_sql("CREATE TRIGGER IF NOT EXISTS msglog_fts_update AFTER UPDATE OF text ON msglog WHEN %s BEGIN "
+                   "INSERT INTO msglog_fts(msglog_fts, rowid, text) VALUES ('delete', old.rowid, old.text); "
+                   "INSERT INTO msglog_fts(rowid, text) VALUES (new.rowid, new.text); END" % (indexed % ("old", "old")))
+    return True
+
+
+# Ordered registry of schema migrations: (version, description, function, online)
+_migrations = []
+
+
+def _migration(version, description, online=False):
+    """
+    Register a schema migration.
+
+    Migrations run in the order of versions, and must be safe to run again
+    if interrupted. Online migrations run in a background thread after
+    startup, together with all migrations after them, and receive a
+    `progress(done, total)` callback.
+
+    Args:
+        version (int): Schema version after the migration.
+        description (str): Description of the migration.
+        online (bool): If the migration runs in background.
     """
-    if i == 0:
-        # Migrate 0: Added Time column in MsgLog table.
-        # 2016JUN15
+    def register(f):
+        _migrations.append((version, description, f, online))
+        _migrations.sort(key=lambda i: i[0])
+        return f
+    return register
+
+
+def _columns(table):
+    return [i.name for i in db.get_columns(table)]
+
+
+@_migration(1, "Added time column in MsgLog table.")  # 2016JUN15
+def _migrate_msg_log_time():
+    if "time" not in _columns("msglog"):
         migrator = SqliteMigrator(db)
         migrate(migrator.add_column("msglog", "time", DateTimeField(default=datetime.datetime.now, null=True)))
+
+
+@_migration(2, "Added FileIdCache table.")
+def _migrate_file_id_cache():
+    db.create_tables([FileIdCache], safe=True)
+
+
+@_migration(3, "Added Telegram chat ID and message ID columns in MsgLog table.")
+def _migrate_msg_log_chat_id():
+    # Needed from the first message, the columns are filled in later by version 5.
+    if "chat_id" not in _columns("msglog"):
+        migrator = SqliteMigrator(db)
+        migrate(migrator.add_column("msglog", "chat_id", BigIntegerField(null=True)),
+                migrator.add_column("msglog", "message_id", BigIntegerField(null=True)))
+
+
+@_migration(5, "Filled in and indexed Telegram chat ID and message ID columns in MsgLog table.", online=True)
+def _migrate_msg_log_chat_id_backfill(progress):
+    # Backfill in batches of rows, so that other writers are not locked out.
+    total = db.execute_sql("SELECT MAX(rowid) FROM msglog").fetchone()[0] or 0
+    batch = _flag("migration_batch_size", 10000)
+    for start in range(0, total, batch):
+        with db.atomic():
+            db.execute_sql("UPDATE msglog SET "
+                           "chat_id = CAST(substr(master_msg_id, 1, instr(master_msg_id, '.') - 1) AS INTEGER), "
+                           "message_id = CAST(substr(master_msg_id, instr(master_msg_id, '.') + 1) AS INTEGER) "
+                           "WHERE rowid > ? AND rowid <= ? AND chat_id IS NULL", (start, start + batch))
+        progress(min(start + batch, total), total)
+    db.execute_sql("CREATE INDEX IF NOT EXISTS msglog_chat_id_time ON msglog (chat_id, time)")
+
+
+@_migration(4, "Added full-text search index of MsgLog table.", online=True)
+def _migrate_msg_log_search(progress):
+    # Rows up to the current last one are indexed in batches, newer rows
+    # by the triggers.
+    with db.atomic():
+        if not _create_search_index():
+            return
+        if not db.execute_sql("SELECT 1 FROM msglog_fts_backfill").fetchone():
+            db.execute_sql("INSERT INTO msglog_fts_backfill (done, last) SELECT 0, IFNULL(MAX(rowid), 0) FROM msglog")
+    done, total = db.execute_sql("SELECT done, last FROM msglog_fts_backfill").fetchone()
+    batch = _flag("migration_batch_size", 10000)
+    while done < total:
+        end = min(done + batch, total)
+        with db.atomic():
+            db.execute_sql("INSERT INTO msglog_fts(rowid, text) SELECT rowid, text FROM msglog "
+                           "WHERE rowid > ? AND rowid <= ?", (done, end))
+            db.execute_sql("UPDATE msglog_fts_backfill SET done = ?", (end,))
+        done = end
+        progress(done, total)
+
+
+def _run_migrations(migrations, background=False):
+    """
+    Run migrations in order, and record the schema version after each.
+
+    Args:
+        migrations (list): Migrations from the registry.
+        background (bool): If running in a background thread.
+    """
+    try:
+        for version, description, f, online in migrations:
+            logger.info("Migrating database to version %s: %s", version, description)
+            if online:
+                f(lambda done, total: logger.info("Migration %s: %s/%s rows.", version, done, total))
+            else:
+                f()
+            SchemaVersion.create(version=version, description=description)
+            logger.info("Database migrated to version %s.", version)
+    except Exception:
+        logger.exception("Database migration failed, it will be retried on next start.")
+        # The code cannot run on the schema before an offline migration.
+        if not background:
+            raise
+    finally:
+        if background:
+            release_connection()
+
+
+def migrate_schema():
+    """
+    Bring the database schema up to date.
+
+    Migrations until the first online one run immediately, the rest run in
+    a background thread.
+    """
+    if not ChatAssoc.table_exists():
+        _create()
+        for version, description, f, online in _migrations:
+            SchemaVersion.create(version=version, description=description)
+        return
+    db.create_tables([SchemaVersion], safe=True)
+    current = SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+    pending = [i for i in _migrations if i[0] > current]
+    for n, migration in enumerate(pending):
+        if migration[3]:
+            _run_migrations(pending[:n])
+            threading.Thread(target=_run_migrations, args=(pending[n:], True),
+                             name="DatabaseMigration", daemon=True).start()
+            break
     else:
-        return False
+        _run_migrations(pending)
 
 
 def add_chat_assoc(master_uid, slave_uid):
@@ -69,9 +625,13 @@ def add_chat_assoc(master_uid, slave_uid):
         master_uid (str): Master channel UID ("%(chat_id)s")
         slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
     """
-    remove_chat_assoc(master_uid=master_uid)
-    remove_chat_assoc(slave_uid=slave_uid)
-    return ChatAssoc.create(master_uid=master_uid, slave_uid=slave_uid)
+    with _assoc_lock:
+        remove_chat_assoc(master_uid=master_uid)
+        remove_chat_assoc(slave_uid=slave_uid)
+        assoc = ChatAssoc.create(master_uid=master_uid, slave_uid=slave_uid)
+        _master_assoc_cache.put(master_uid, slave_uid)
+        _slave_assoc_cache.put(slave_uid, master_uid)
+        return assoc
 
 
 def remove_chat_assoc(master_uid=None, slave_uid=None):
@@ -83,15 +643,20 @@ def remove_chat_assoc(master_uid=None, slave_uid=None):
         master_uid (str): Master channel UID ("%(chat_id)s")
         slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
     """
-    try:
-        if bool(master_uid) == bool(slave_uid):
-            raise ValueError("Only one parameter is to be provided.")
-        elif master_uid:
-            return ChatAssoc.delete().where(ChatAssoc.master_uid == master_uid).execute()
-        elif slave_uid:
-            return ChatAssoc.delete().where(ChatAssoc.slave_uid == slave_uid).execute()
-    except DoesNotExist:
-        return 0
+    if bool(master_uid) == bool(slave_uid):
+        raise ValueError("Only one parameter is to be provided.")
+    with _assoc_lock:
+        try:
+            if master_uid:
+                query = ChatAssoc.master_uid == master_uid
+            else:
+                query = ChatAssoc.slave_uid == slave_uid
+            for i in ChatAssoc.select().where(query):
+                _master_assoc_cache.put(i.master_uid, None)
+                _slave_assoc_cache.put(i.slave_uid, None)
+            return ChatAssoc.delete().where(query).execute()
+        except DoesNotExist:
+            return 0
 
 
 def get_chat_assoc(master_uid=None, slave_uid=None):
@@ -99,6 +664,9 @@ def get_chat_assoc(master_uid=None, slave_uid=None):
     Get chat association (chat link) information.
     Only one parameter is to be provided.
 
+    Lookups are served from an in-memory cache, including chats without
+    association, and only query the database on a cache miss.
+
     Args:
         master_uid (str): Master channel UID ("%(chat_id)s")
         slave_uid (str): Slave channel UID ("%(channel_id)s.%(chat_id)s")
@@ -106,30 +674,38 @@ def get_chat_assoc(master_uid=None, slave_uid=None):
     Returns:
         str: The counterpart ID.
     """
-    try:
-        if bool(master_uid) == bool(slave_uid):
-            raise ValueError("Only one parameter is to be provided.")
-        elif master_uid:
-            return ChatAssoc.get(ChatAssoc.master_uid == master_uid).slave_uid
-        elif slave_uid:
-            return ChatAssoc.get(ChatAssoc.slave_uid == slave_uid).master_uid
-    except DoesNotExist:
-        return None
-
-
-def get_last_msg_from_chat(chat_id):
-    """Get last message from the selected chat from Telegram
-
-    Args:
-        chat_id (int|str): Telegram chat ID
+    if bool(master_uid) == bool(slave_uid):
+        raise ValueError("Only one parameter is to be provided.")
+    if master_uid:
+        key, cache = master_uid, _master_assoc_cache
+    else:
+        key, cache = slave_uid, _slave_assoc_cache
+    found, value = cache.get(key)
+    if found:
+        return value
+    with _assoc_lock:
+        row = db.execute_sql(_SQL_GET_SLAVE_UID if master_uid else _SQL_GET_MASTER_UID, (key,)).fetchone()
+        value = row[0] if row else None
+        cache.put(key, value)
+    return value
+
+
+def get_cache_stats():
+    """
+    Get statistics of in-memory caches of the database.
 
     Returns:
-        MsgLog: The last message from the chat
+        dict: Statistics of each cache, see `_LRUCache.stats`.
     """
-    try:
-        return MsgLog.select().where(MsgLog.master_msg_id.startswith("%s." % chat_id)).order_by(MsgLog.time.desc()).first()
-    except DoesNotExist:
-        return None
+    return {"master_assoc": _master_assoc_cache.stats(),
+            "slave_assoc": _slave_assoc_cache.stats(),
+            "msg_log": _msg_log_cache.stats()}
+
+
+def _log_cache_stats(interval):
+    while True:
+        time.sleep(interval)
+        logger.info("Database cache statistics: %s", get_cache_stats())
 
 
 def add_msg_log(**kwargs):
@@ -153,7 +729,7 @@ def add_msg_log(**kwargs):
         update (bool): Update a previous record. Default: False.
 
     Returns:
-        MsgLog: The added/updated entry.
+        MsgLogRow: The added/updated entry.
     """
     master_msg_id = kwargs.get('master_msg_id')
     text = kwargs.get('text')
@@ -164,45 +740,134 @@ def add_msg_log(**kwargs):
     slave_member_uid = kwargs.get('slave_member_uid', None)
     slave_member_display_name = kwargs.get('slave_member_display_name', None)
     update = kwargs.get('update', False)
+    chat_id, message_id = (int(i) for i in master_msg_id.split(".", 1))
+    msg_time = datetime.datetime.now()
     if update:
-        msg_log = MsgLog.get(MsgLog.master_msg_id == master_msg_id)
-        msg_log.text = text
-        msg_log.msg_type = msg_type
-        msg_log.sent_to = sent_to
-        msg_log.slave_origin_uid = slave_origin_uid
-        msg_log.slave_origin_display_name = slave_origin_display_name
-        msg_log.slave_member_uid = slave_member_uid
-        msg_log.slave_member_display_name = slave_member_display_name
-        msg_log.save()
-        return msg_log
+        previous = get_msg_log(master_msg_id)
+        if previous:
+            msg_time = previous.time
+    row = MsgLogRow(master_msg_id=master_msg_id,
+                    text=text,
+                    slave_origin_uid=slave_origin_uid,
+                    slave_origin_display_name=slave_origin_display_name,
+                    slave_member_uid=slave_member_uid,
+                    slave_member_display_name=slave_member_display_name,
+                    msg_type=msg_type,
+                    sent_to=sent_to,
+                    time=msg_time,
+                    chat_id=chat_id,
+                    message_id=message_id)
+    if _msg_log_writer:
+        _msg_log_writer.put(row)
     else:
-        return MsgLog.create(master_msg_id=master_msg_id,
-                             text=text,
-                             slave_origin_uid=slave_origin_uid,
-                             msg_type=msg_type,
-                             sent_to=sent_to,
-                             slave_origin_display_name=slave_origin_display_name,
-                             slave_member_uid=slave_member_uid,
-                             slave_member_display_name=slave_member_display_name)
+        _put_msg_log(row)
+    _msg_log_cache.put(master_msg_id, row)
+    return row
 
 
 def get_msg_log(master_msg_id):
     """Get message log by message ID.
+    Recent entries are served from memory, without querying the database.
 
     Args:
         master_msg_id (str): Telegram msessage ID ("%(chat_id)s.%(msg_id)s")
 
     Returns:
-        MsgLog|None: The queried entry, None if not exist.
+        MsgLogRow|None: The queried entry, None if not exist.
+    """
+    logger.debug("get_msg_log %s", master_msg_id)
+    found, msg_log = _msg_log_cache.get(master_msg_id)
+    if found:
+        return msg_log
+    msg_log = _msg_log_writer and _msg_log_writer.get(master_msg_id)
+    if msg_log:
+        return msg_log
+    msg_log = _msg_log_row(db.execute_sql(_SQL_GET_MSG_LOG, (master_msg_id,)).fetchone())
+    if msg_log is None and _flag("msg_log_archive", False):
+        msg_log = _MsgLogPruner.find_archived(master_msg_id)
+    # Entries added meanwhile by `add_msg_log` are not overwritten.
+    _msg_log_cache.add(master_msg_id, msg_log)
+    return msg_log
+
+
+def search_msg_log(query, chat_id=None, offset=0, limit=10):
+    """
+    Search message log by text, ranked by relevance.
+
+    Args:
+        query (str): Words to search for, all of which must match.
+        chat_id (int): Telegram chat ID to search in, None for all chats.
+        offset (int): Number of results to skip.
+        limit (int): Maximum number of results.
+
+    Returns:
+        list of MsgLogSearchResult: Matching entries, with a `snippet` of the matching text.
+    """
+    if _msg_log_writer:
+        _msg_log_writer.flush()
+    terms = " ".join('"%s"' % i.replace('"', '""') for i in query.split())
+    sql = _SQL_SEARCH_MSG_LOG
+    params = [terms]
+    if chat_id is not None:
+        sql += " AND msglog.chat_id = ?"
+        params.append(int(chat_id))
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    results = []
+    for values in db.execute_sql(sql, params).fetchall():
+        result = MsgLogSearchResult(*values)
+        results.append(result._replace(time=_parse_time(result.time)))
+    return results
+
+
+def get_file_id(file_key):
+    """
+    Get the Telegram file ID of a file uploaded before.
+
+    Args:
+        file_key (str): Key of the file ("%(method)s.%(content_hash)s")
+
+    Returns:
+        str|None: The file ID, None if the file is not uploaded before.
     """
-    logger.info("get_msg_log %s" % master_msg_id)
     try:
-        return MsgLog.select().where(MsgLog.master_msg_id == master_msg_id).order_by(MsgLog.time.desc()).first()
+        return FileIdCache.get(FileIdCache.file_key == file_key).file_id
     except DoesNotExist:
         return None
 
+
+def set_file_id(file_key, file_id):
+    """
+    Record the Telegram file ID of an uploaded file.
+
+    Args:
+        file_key (str): Key of the file ("%(method)s.%(content_hash)s")
+        file_id (str): File ID returned by Telegram
+    """
+    return FileIdCache.insert(file_key=file_key, file_id=file_id,
+                              time=datetime.datetime.now()).on_conflict('REPLACE').execute()
+
 db.connect()
-if not ChatAssoc.table_exists():
-    _create()
-elif "time" not in [i.name for i in db.get_columns("msglog")]:
-    _migrate(0)
+# The full vacuum needed once by the pruner locks the database, so it is
+# done before anything else uses it.
+if (_flag("msg_log_retention_days", 0) or _flag("msg_log_retention_count", 0)) and _flag("msg_log_vacuum", False):
+    _MsgLogPruner.enable_vacuum()
+migrate_schema()
+
+# Message log entries are written behind in batches, unless disabled by
+# setting the flush interval to 0.
+_msg_log_writer = None
+if _flag("msg_log_flush_interval", 1) > 0:
+    _msg_log_writer = _MsgLogWriter(_flag("msg_log_flush_interval", 1))
+    atexit.register(_msg_log_writer.flush)
+
+# Hit rates of the caches are logged periodically, unless disabled by
+# setting the interval to 0.
+if _flag("db_cache_stats_interval_secs", 3600) > 0:
+    threading.Thread(target=_log_cache_stats, args=(_flag("db_cache_stats_interval_secs", 3600),),
+                     name="DatabaseCacheStats", daemon=True).start()
+
+# Expired message log entries are pruned in background, if retention is set.
+if _flag("msg_log_retention_days", 0) or _flag("msg_log_retention_count", 0):
+    _MsgLogPruner(_flag("msg_log_retention_days", 0), _flag("msg_log_retention_count", 0),
+                  _flag("msg_log_archive", False), _flag("msg_log_vacuum", False))
@@ -0,0 +1,75 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class DownloadManager:
+    """
+    Download files in a bounded pool of threads.
+
+    Concurrent requests for the same key (e.g. Telegram file ID) share a
+    single download. Each requester receives its own `EFBMedia` payload
+    through a `concurrent.futures.Future`, and is responsible for closing it.
+
+    Args:
+        workers (int): Maximum number of concurrent downloads.
+        max_size (int): Size limit in bytes of files to download, `None` for no limit.
+    """
+
+    def __init__(self, workers=4, max_size=None):
+        self.max_size = max_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.logger = logging.getLogger("plugins.eh_telegram_master.download")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, key, download, size=None):
+        """
+        Request a file to be downloaded.
+
+        Args:
+            key (str): Key identifying the file, requests with the same key
+                while it is being downloaded are merged.
+            download (callable): Function downloading the file, returning an `EFBMedia`.
+            size (int): Size of the file in bytes if known, checked against `max_size`.
+
+        Returns:
+            concurrent.futures.Future: Future of the `EFBMedia` payload. Raises
+                `DownloadTooLarge` if the file exceeds the size limit.
+        """
+        future = Future()
+        if size and self.max_size and size > self.max_size:
+            future.set_exception(DownloadTooLarge(size))
+            return future
+        with self._lock:
+            waiters = self._jobs.get(key)
+            if waiters is None:
+                waiters = self._jobs[key] = []
+                self.executor.submit(self._run, key, download)
+            else:
+                self.logger.debug("Download of %s is in progress, request merged.", key)
+            waiters.append(future)
+        return future
+
+    def _run(self, key, download):
+        try:
+            media, error = download(), None
+        except Exception as e:
+            self.logger.exception("Failed to download %s.", key)
+            media, error = None, e
+        with self._lock:
+            waiters = self._jobs.pop(key)
+        for i, future in enumerate(waiters):
+            if error:
+                future.set_exception(error)
+            elif i == len(waiters) - 1:
+                future.set_result(media)
+            else:
+                try:
+                    future.set_result(media.copy())
+                except Exception as e:
+                    future.set_exception(e)
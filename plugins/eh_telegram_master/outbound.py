@@ -0,0 +1,140 @@
+import time
+import logging
+import itertools
+import threading
+from collections import deque
+
+
+class OutboundQueue:
+    """
+    Queue of messages to be sent to a slave channel.
+
+    Jobs are run by a set of worker threads. Jobs of the same destination
+    are run one at a time, in the order they are queued, while jobs of
+    different destinations are run concurrently.
+
+    A job is only handed to a worker once `throttle` allows its
+    destination, so that destinations over their rate limit wait in the
+    queue without holding up workers. Among destinations ready to send,
+    jobs with a lower `priority` value are run first. `throttle` is called
+    by workers without holding the queue, as it may be slow.
+
+    Args:
+        name (str): Name of the queue, used in thread names and logs.
+        workers (int): Number of worker threads.
+        throttle (callable): Function taking a destination, returning 0 if a
+            job can be sent to it now, reserving its budget, or the time in
+            seconds to wait otherwise. No limit if omitted.
+        release (callable): Function taking a destination, called after
+            each job to return a budget reserved but not used by the job.
+    """
+
+    def __init__(self, name, workers=2, throttle=None, release=None):
+        self.name = name
+        self.throttle = throttle
+        self.release = release
+        self.logger = logging.getLogger("plugins.eh_telegram_master.outbound.%s" % name)
+        self._pending = {}
+        self._busy = set()
+        self._ready_at = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        for i in range(max(workers, 1)):
+            t = threading.Thread(target=self._worker, name="%s-outbound-%s" % (name, i), daemon=True)
+            t.start()
+
+    def put(self, destination, job, *args, priority=0):
+        """
+        Queue a job, and return immediately.
+
+        Args:
+            destination (str): Identifier of the destination of the job.
+            job (callable): Function to be called by the worker.
+            *args: Arguments to call `job` with.
+            priority (int): Priority of the job, lower values first.
+        """
+        with self._cond:
+            self._pending.setdefault(destination, deque()).append((priority, next(self._seq), job, args))
+            self._cond.notify()
+
+    def qsize(self):
+        """
+        Returns:
+            int: Approximate number of jobs waiting in the queue.
+        """
+        with self._cond:
+            return sum(len(i) for i in self._pending.values())
+
+    def _claim(self):
+        """
+        Find the destination of the next job to run, and mark it as busy.
+        To be called with the queue held.
+
+        Returns:
+            tuple: The destination, or `None` if no destination is ready,
+                and the time to wait in seconds until one may be ready.
+        """
+        now = time.monotonic()
+        delay = None
+        best = None
+        for destination, jobs in self._pending.items():
+            if destination in self._busy:
+                continue
+            ready_at = self._ready_at.get(destination, 0)
+            if ready_at > now:
+                delay = ready_at - now if delay is None else min(delay, ready_at - now)
+            elif best is None or jobs[0][:2] < self._pending[best][0][:2]:
+                best = destination
+        if best is not None:
+            self._busy.add(best)
+        return best, delay
+
+    def _next(self):
+        """
+        Wait for the next job to run, and mark its destination as busy.
+
+        Returns:
+            tuple: Destination and job.
+        """
+        while True:
+            with self._cond:
+                while True:
+                    destination, delay = self._claim()
+                    if destination is not None:
+                        break
+                    # Woken up by new or finished jobs, or when the next
+                    # destination is allowed to send.
+                    self._cond.wait(delay)
+            try:
+                d = self.throttle(destination) if self.throttle else 0
+            except Exception:
+                self.logger.exception("Failed to check the rate limit of %s.", destination)
+                d = 0
+            with self._cond:
+                if not d:
+                    self._ready_at.pop(destination, None)
+                    jobs = self._pending[destination]
+                    head = jobs.popleft()
+                    if not jobs:
+                        del self._pending[destination]
+                    return destination, head
+                self._ready_at[destination] = time.monotonic() + d
+                self._busy.discard(destination)
+                self._cond.notify()
+
+    def _worker(self):
+        while True:
+            destination, (priority, seq, job, args) = self._next()
+            try:
+                job(*args)
+            except Exception:
+                self.logger.exception("Error occurred while running outbound job.")
+            finally:
+                if self.release:
+                    try:
+                        self.release(destination)
+                    except Exception:
+                        self.logger.exception("Failed to release the budget of %s.", destination)
+                with self._cond:
+                    self._busy.discard(destination)
+                    self._cond.notify_all()
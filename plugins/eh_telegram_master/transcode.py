@@ -0,0 +1,135 @@
+import io
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TranscodeError(Exception):
+    pass
+
+
+class Transcoder:
+    """
+    Media transcoding stage backed by ffmpeg.
+
+    Media is piped through ffmpeg in memory, without temporary files.
+    Each job runs in its own ffmpeg process; `workers` bounds the number
+    of ffmpeg processes running at the same time, so that media-heavy
+    chats do not tie up delivery threads or overload the host.
+
+    Args:
+        workers (int): Maximum number of concurrent ffmpeg processes.
+        ffmpeg (str): Path to the ffmpeg executable.
+        ffprobe (str): Path to the ffprobe executable.
+    """
+
+    def __init__(self, workers=2, ffmpeg="ffmpeg", ffprobe="ffprobe"):
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.logger = logging.getLogger("plugins.eh_telegram_master.transcode")
+
+    def _run(self, args, data):
+        """
+        Run ffmpeg with `data` piped as input.
+
+        Args:
+            args (list of str): ffmpeg arguments, excluding the executable.
+            data (bytes): Input data.
+
+        Returns:
+            bytes: Output of ffmpeg.
+
+        Raises:
+            TranscodeError: Raised when ffmpeg exits with error.
+        """
+        p = subprocess.run([self.ffmpeg, "-hide_banner", "-loglevel", "error"] + args,
+                           input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode:
+            raise TranscodeError(p.stderr.decode(errors="replace"))
+        return p.stdout
+
+    def _frame_rate(self, src):
+        """
+        Probe the frame rate of the first video stream of a file.
+
+        Args:
+            src (str): Path to the video.
+
+        Returns:
+            float: Frame rate, `None` if it cannot be determined.
+        """
+        try:
+            p = subprocess.run([self.ffprobe, "-v", "error", "-select_streams", "v:0",
+                                "-show_entries", "stream=r_frame_rate", "-of", "csv=p=0", src],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            num, _, den = p.stdout.decode().strip().partition("/")
+            return float(num) / float(den or 1)
+        except (OSError, ValueError, ZeroDivisionError):
+            self.logger.debug("Failed to probe frame rate of %s.", src)
+            return None
+
+    def _voice(self, data):
+        out = io.BytesIO(self._run(["-i", "pipe:0", "-vn", "-c:a", "libopus", "-f", "ogg", "pipe:1"], data))
+        out.name = "voice.ogg"
+        return out
+
+    def _gif(self, src, dest, max_size, max_fps):
+        scale = "scale='min(%d,iw)':'min(%d,ih)':force_original_aspect_ratio=decrease:flags=lanczos" % (max_size, max_size)
+        fps = self._frame_rate(src)
+        if fps is None or fps > max_fps:
+            scale = "fps=%d,%s" % (max_fps, scale)
+        graph = "%s,split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse" % scale
+        self._run(["-i", src, "-an", "-filter_complex", graph, "-f", "gif", "-y", dest], None)
+        return dest
+
+    def submit_gif(self, src, dest, max_size=480, max_fps=15):
+        """
+        Convert a video to GIF asynchronously, in a single streaming pass
+        with a palette generated for the clip. The frame rate is only
+        reduced for clips faster than `max_fps`.
+
+        Args:
+            src (str): Path to the video.
+            dest (str): Path to save the GIF.
+            max_size (int): Maximum width and height of the GIF in pixels.
+            max_fps (int): Maximum frame rate of the GIF.
+
+        Returns:
+            concurrent.futures.Future: Future of the path to the GIF.
+        """
+        return self.executor.submit(self._gif, src, dest, max_size, max_fps)
+
+    def gif(self, src, dest, max_size=480, max_fps=15):
+        """
+        Convert a video to GIF, and wait for the result.
+        See `submit_gif` for details.
+
+        Returns:
+            str: Path to the GIF.
+        """
+        return self.submit_gif(src, dest, max_size, max_fps).result()
+
+    def submit_voice(self, data):
+        """
+        Convert audio to an Ogg Opus voice message asynchronously.
+
+        Args:
+            data (bytes): Audio file content.
+
+        Returns:
+            concurrent.futures.Future: Future of a `io.BytesIO` buffer with the voice message.
+        """
+        return self.executor.submit(self._voice, data)
+
+    def voice(self, data):
+        """
+        Convert audio to an Ogg Opus voice message, and wait for the result.
+
+        Args:
+            data (bytes): Audio file content.
+
+        Returns:
+            io.BytesIO: Buffer of the voice message.
+        """
+        return self.submit_voice(data).result()
@@ -1,4 +1,5 @@
 import itchat
+import config
 import re
 import xmltodict
 import logging
@@ -9,13 +10,129 @@ import magic
 import mimetypes
 from PIL import Image
 from binascii import crc32
-from channel import EFBChannel, EFBMsg, MsgType, MsgSource, TargetType, ChannelType
-from utils import extra
+import tempfile
+from channel import EFBChannel, EFBMsg, EFBMedia, MsgType, MsgSource, TargetType, ChannelType
+from utils import extra, MediaCache, SendScheduler
 from channelExceptions import EFBMessageTypeNotSupported
 
+# Lookup table turning an alpha channel into the GIF transparency mask,
+# applied by `Image.point` in C instead of calling back into Python.
+GIF_ALPHA_MASK_LUT = [255 if a <= 128 else 0 for a in range(256)]
+
+
+def convert_to_gif(src, dest):
+    """
+    Convert an image (PNG, WebP, etc.) to a GIF with 1-bit transparency.
+
+    Args:
+        src (str|file): Path to or file object of the source image.
+        dest (str): Path to save the converted GIF image.
+
+    Returns:
+        str: Path to the converted GIF image.
+    """
+    img = Image.open(src)
+    if img.mode == "PA" or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+    mask = img.getchannel("A").point(GIF_ALPHA_MASK_LUT) if "A" in img.getbands() else None
+    img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
+    if mask is not None:
+        img.paste(255, mask)
+    img.save(dest, "GIF", transparency=255)
+    return dest
+
+
+class MsgRules:
+    """
+    Rules to drop or downgrade incoming WeChat messages, evaluated on the
+    raw ItChat message before any lookup or download takes place.
+
+    Each rule is a dict of conditions and an action, all conditions given
+    must match for the rule to apply. The first matching rule wins.
+
+    Conditions:
+        types (list of str): ItChat message types, e.g. "Picture", "Video", "Sharing"
+        group (bool): If the message is from a group
+        mp (bool): If the message is from an official account (MPS)
+        chat (str): Regular expression matching the name or alias of the chat
+        member (str): Regular expression matching the name of the sender in a group
+        user_name (str): Regular expression matching the ItChat `UserName` of the chat
+        min_members (int): Minimum number of members of the group
+
+    Actions:
+        "drop": Discard the message.
+        "text": Deliver media messages as a text notice, without downloading the media.
+    """
+    DROP = "drop"
+    TEXT = "text"
+
+    def __init__(self, rules):
+        self.rules = []
+        for rule in rules or []:
+            if rule.get("action") not in (self.DROP, self.TEXT):
+                raise ValueError("Action of a message rule must be \"drop\" or \"text\", %s given." % rule.get("action"))
+            rule = rule.copy()
+            for key in ("chat", "member", "user_name"):
+                if key in rule:
+                    rule[key] = re.compile(rule[key])
+            if "types" in rule:
+                rule["types"] = set(rule["types"])
+            self.rules.append(rule)
+
+    @staticmethod
+    def _chat(msg):
+        UserName = msg['FromUserName']
+        return (itchat.search_chatrooms(userName=UserName) or itchat.search_friends(userName=UserName) or
+                itchat.search_mps(userName=UserName) or {})
+
+    def match(self, msg, isGroupChat=False):
+        """
+        Find the action to take on a message.
+
+        Args:
+            msg (dict): ItChat message dict.
+            isGroupChat (bool): If the message is from a group.
+
+        Returns:
+            str|None: Action of the first matching rule, `None` if no rule matches.
+        """
+        chat = None
+        for rule in self.rules:
+            if "types" in rule and msg['Type'] not in rule['types']:
+                continue
+            if "group" in rule and rule['group'] != isGroupChat:
+                continue
+            if "user_name" in rule and not rule['user_name'].search(msg['FromUserName']):
+                continue
+            if "member" in rule and not (isGroupChat and rule['member'].search(msg.get('ActualNickName', ''))):
+                continue
+            if any(key in rule for key in ("mp", "chat", "min_members")):
+                if chat is None:
+                    chat = self._chat(msg)
+                if "mp" in rule and rule['mp'] != bool(itchat.search_mps(userName=msg['FromUserName'])):
+                    continue
+                if "chat" in rule and not any(rule['chat'].search(chat.get(i) or '')
+                                              for i in ('NickName', 'RemarkName', 'DisplayName')):
+                    continue
+                if "min_members" in rule and \
+                        (chat.get('MemberCount') or len(chat.get('MemberList') or [])) < rule['min_members']:
+                    continue
+            return rule['action']
+        return None
+
+
 def incomeMsgMeta(func):
     def wcFunc(self, msg, isGroupChat=False):
-        mobj = func(self, msg, isGroupChat)
+        action = self.msg_rules.match(msg, isGroupChat)
+        if action == MsgRules.DROP:
+            self.logger.debug("WeChat message dropped by rules: %s from %s", msg['Type'], msg['FromUserName'])
+            return
+        elif action == MsgRules.TEXT and msg['Type'] in self.MEDIA_NOTICES:
+            mobj = EFBMsg(self)
+            mobj.type = MsgType.Text
+            mobj.text = self.MEDIA_NOTICES[msg['Type']] % msg
+        else:
+            mobj = func(self, msg, isGroupChat)
         FromUser = self.search_user(UserName=msg['FromUserName'])[0] or {"NickName": "User error. (UE01)", "Alias": "User error. (UE01)"}
         if isGroupChat:
             member = self.search_user(UserName=msg['FromUserName'], ActualUserName=msg['ActualUserName'])[0]['MemberList'][0]
@@ -37,6 +154,7 @@ def incomeMsgMeta(func):
                 'alias': FromUser['RemarkName'] or FromUser['NickName'],
                 'uid': self.get_uid(UserName=msg['FromUserName'])
             }
+        mobj.time = msg.get('CreateTime') or mobj.time
         mobj.destination = {
             'name': itchat.get_friends()[0]['NickName'],
             'alias': itchat.get_friends()[0]['NickName'],
@@ -56,6 +174,17 @@ class WeChatChannel(EFBChannel):
     Based on itchat (modified by Eana Hufwe)
 
     Author: Eana Hufwe <https://github.com/blueset>
+
+    Additional configs:
+    eh_wechat_slave = {
+        "rules": [
+            {"mp": True, "action": "drop"},
+            {"group": True, "types": ["Video", "Attachment"], "action": "text"}
+        ],
+        "flags": {
+            "flag_name": "flag_value"
+        }
+    }
     """
     channel_name = "WeChat Slave"
     channel_emoji = "💬"
@@ -63,9 +192,22 @@ class WeChatChannel(EFBChannel):
     channel_type = ChannelType.Slave
     users = {}
     logger = logging.getLogger("plugins.eh_wechat_slave.WeChatChannel")
+    MEDIA_NOTICES = {
+        "Picture": "sent a picture.",
+        "Recording": "sent a voice message.",
+        "Attachment": "sent a file: %(FileName)s",
+        "Video": "sent a video."
+    }
 
     def __init__(self, queue):
         super().__init__(queue)
+        self.msg_rules = MsgRules(getattr(config, "eh_wechat_slave", dict()).get("rules", []))
+        self.gif_cache = MediaCache(os.path.join("storage", self.channel_id, "cache"),
+                                    self._flag("media_cache_size_mb", 64) * 1024 * 1024)
+        self.scheduler = SendScheduler(self._flag("send_rate", 1), self._flag("send_burst", 10),
+                                       self._flag("chat_send_rate", 0.5), self._flag("chat_send_burst", 5))
+        # Chat UID: UserName, of budgets reserved by `reserve_send`
+        self._reservations = {}
         itchat.auto_login(enableCmdQR=2, hotReload=True, exitCallback=self.exit_callback, qrCallback=self.console_qr_code)
         self.logger.info("EWS Inited!!!\n---")
         itchat.set_logging(showOnCmd=False)
@@ -363,37 +505,36 @@ class WeChatChannel(EFBChannel):
     def pictureMsg(self, msg, isGroupChat=False):
         mobj = EFBMsg(self)
         mobj.type = MsgType.Image if msg['MsgType'] == 3 else MsgType.Sticker
-        mobj.path, mime = self.save_file(msg, mobj.type)
+        mobj.media = self.get_media(msg, mobj.type)
+        mobj.mime = mobj.media.mime
         mobj.text = None
-        mobj.file = open(mobj.path, "rb")
-        mobj.mime = mime
         return mobj
 
     @incomeMsgMeta
     def fileMsg(self, msg, isGroupChat=False):
         mobj = EFBMsg(self)
         mobj.type = MsgType.File
-        mobj.path, mobj.mime = self.save_file(msg, mobj.type)
+        mobj.media = self.get_media(msg, mobj.type, msg['FileName'])
+        mobj.mime = mobj.media.mime
         mobj.text = msg['FileName']
-        mobj.file = open(mobj.path, "rb")
         return mobj
 
     @incomeMsgMeta
     def voiceMsg(self, msg, isGroupChat=False):
         mobj = EFBMsg(self)
         mobj.type = MsgType.Audio
-        mobj.path, mobj.mime = self.save_file(msg, mobj.type)
+        mobj.media = self.get_media(msg, mobj.type)
+        mobj.mime = mobj.media.mime
         mobj.text = None
-        mobj.file = open(mobj.path, "rb")
         return mobj
 
     @incomeMsgMeta
     def videoMsg(self, msg, isGroupChat=False):
         mobj = EFBMsg(self)
-        mobj.path, mobj.mime = self.save_file(msg, MsgType.Video)
         mobj.type = MsgType.Video
+        mobj.media = self.get_media(msg, mobj.type)
+        mobj.mime = mobj.media.mime
         mobj.text = None
-        mobj.file = open(mobj.path, "rb")
         return mobj
 
     @incomeMsgMeta
@@ -452,21 +593,33 @@ class WeChatChannel(EFBChannel):
         }
         return mobj
 
-    def save_file(self, msg, msg_type):
-        path = os.path.join("storage", self.channel_id)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        filename = "%s_%s_%s" % (msg_type, msg['NewMsgId'], int(time.time()))
-        fullpath = os.path.join(path, filename)
-        msg['Text'](fullpath)
-        mime = magic.from_file(fullpath, mime=True)
-        if type(mime) is bytes:
-            mime = mime.decode()
-        ext = "jpg" if mime == "image/jpeg" else mimetypes.guess_extension(mime)
-        os.rename(fullpath, "%s.%s" % (fullpath, ext))
-        fullpath = "%s.%s" % (fullpath, ext)
-        self.logger.info("File saved from WeChat\nFull path: %s\nMIME: %s", fullpath, mime)
-        return fullpath, mime
+    def get_media(self, msg, msg_type, filename=None):
+        """
+        Get the media of a message from WeChat, as a deferred payload
+        downloaded only when it is first read.
+
+        Args:
+            msg (dict): ItChat message dict.
+            msg_type (MsgType): Type of the message.
+            filename (str): File name of the media, generated from the message if omitted.
+
+        Returns:
+            EFBMedia: Payload of the media.
+        """
+        def fetch(media):
+            data = msg['Text']()
+            mime = magic.from_buffer(data, mime=True)
+            if type(mime) is bytes:
+                mime = mime.decode()
+            media.mime = mime
+            if not filename:
+                media.name += ".jpg" if mime == "image/jpeg" else mimetypes.guess_extension(mime) or ""
+            media.write(data)
+            self.logger.info("File downloaded from WeChat\nName: %s\nSize: %s\nMIME: %s", media.name, media.size, mime)
+
+        size = int(msg.get('FileSize') or 0) or None
+        name = filename or "%s_%s_%s" % (msg_type, msg['NewMsgId'], int(time.time()))
+        return EFBMedia.deferred(fetch, size, name=name, spool_dir=os.path.join("storage", self.channel_id))
 
     def send_message(self, msg):
         """Send a message to WeChat.
@@ -496,41 +649,87 @@ class WeChatChannel(EFBChannel):
                     msg.text = "@%s\u2005 %s" % (msg.target['target'].member['alias'], msg.text)
                 elif msg.target['type'] == TargetType.Message:
                     msg.text = "@%s\u2005 「%s」\n\n%s" % (msg.target['target'].member['alias'], msg.target['target'].text, msg.text)
+            self._wait_to_send(UserName, msg.type)
             r = itchat.send(msg.text, UserName)
             return r
         elif msg.type in [MsgType.Image, MsgType.Sticker]:
             self.logger.info("Image/Sticker %s", msg.type)
-            if msg.mime in ["image/gif", "image/jpeg"]:
-                r = itchat.send_image(msg.path, UserName)
-                os.remove(msg.path)
-                return r
-            else:  # Convert Image format
-                img = Image.open(msg.path)
+            with msg.get_media() as media:
+                if msg.mime in ["image/gif", "image/jpeg"]:
+                    self._wait_to_send(UserName, msg.type)
+                    return itchat.send_image(media.path, UserName)
+                # Convert Image format
+                fd, gif_path = tempfile.mkstemp(suffix=".gif", dir=os.path.join("storage", self.channel_id))
+                os.close(fd)
                 try:
-                    alpha = img.split()[3]
-                    mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
-                except IndexError:
-                    mask = Image.eval(img.split()[0], lambda a: 0)
-                img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
-                img.paste(255, mask)
-                img.save("%s.gif" % msg.path, transparency=255)
-                msg.path = "%s.gif" % msg.path
-                self.logger.info('Image converted to GIF: %s', msg.path)
-            self.logger.info('Sending Image...')
-            r = itchat.send_image(msg.path, UserName)
-            self.logger.info('Image sent with result %s', r)
-            os.remove(msg.path)
-            if not msg.mime == "image/gif":
-                os.remove(msg.path[:-4])
-            return r
+                    cache_key = "gif.%s" % media.digest()
+                    if self.gif_cache.get(cache_key, gif_path):
+                        self.logger.info('Converted GIF found in cache: %s', gif_path)
+                    else:
+                        convert_to_gif(media.open(), gif_path)
+                        self.gif_cache.put(cache_key, gif_path)
+                        self.logger.info('Image converted to GIF: %s', gif_path)
+                    self._wait_to_send(UserName, msg.type)
+                    self.logger.info('Sending Image...')
+                    r = itchat.send_image(gif_path, UserName)
+                    self.logger.info('Image sent with result %s', r)
+                    return r
+                finally:
+                    os.remove(gif_path)
         elif msg.type in [MsgType.File, MsgType.Video]:
-            self.logger.info("Sending file to WeChat\nFileName: %s\nPath: %s", msg.text, msg.path)
-            r = itchat.send_file(msg.path, UserName)
-            os.remove(msg.path)
-            return r
+            with msg.get_media() as media:
+                self.logger.info("Sending file to WeChat\nFileName: %s\nPath: %s", msg.text, media.path)
+                self._wait_to_send(UserName, msg.type)
+                return itchat.send_file(media.path, UserName)
         else:
             raise EFBMessageTypeNotSupported()
 
+    def reserve_send(self, chat_uid):
+        """
+        Reserve the budget of `chat_send_rate` for the next message to a chat.
+
+        Args:
+            chat_uid (str): UID of the chat.
+
+        Returns:
+            float: 0 if the next message can be sent now, otherwise the
+                time in seconds to wait before trying again.
+        """
+        UserName = self.get_UserName(chat_uid)
+        if not UserName:
+            return 0
+        delay = self.scheduler.reserve(UserName)
+        if not delay:
+            self._reservations[chat_uid] = UserName
+        return delay
+
+    def release_send(self, chat_uid):
+        """
+        Return the budget reserved by `reserve_send` for a chat, if it is
+        not used by the message.
+
+        Args:
+            chat_uid (str): UID of the chat.
+        """
+        UserName = self._reservations.pop(chat_uid, None)
+        if UserName:
+            self.scheduler.release(UserName)
+
+    def _wait_to_send(self, UserName, msg_type):
+        """
+        Wait until a message can be sent without exceeding the send rate
+        limits of WeChat. Text messages are sent before media. A budget
+        reserved with `reserve_send` is used when there is one.
+
+        Args:
+            UserName (str): UserName of the recipient.
+            msg_type (str): Type of the message.
+        """
+        waited = self.scheduler.acquire(UserName, 0 if msg_type == MsgType.Text else 1)
+        if waited >= 1:
+            self.logger.debug("Message to %s waited %.1fs to be sent. Scheduler: %s",
+                              UserName, waited, self.scheduler.stats())
+
     # Extra functions
 
     @extra(name="Show chat list",
@@ -649,3 +848,16 @@ class WeChatChannel(EFBChannel):
 
     def get_itchat(self):
         return itchat
+
+    def _flag(self, key, value):
+        """
+        Retrieve value for experimental flags.
+
+        Args:
+            key: Key of the flag.
+            value: Default/fallback value.
+
+        Returns:
+            Value for the flag.
+        """
+        return getattr(config, "eh_wechat_slave", dict()).get('flags', dict()).get(key, value)
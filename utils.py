@@ -1,3 +1,14 @@
+import os
+import time
+import queue
+import shutil
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict, deque
+from channel import MsgType, MsgSource
+
+
 class Emojis:
     GROUP_EMOJI = "👥"
     USER_EMOJI = "👤"
@@ -26,3 +37,397 @@ def extra(**kw):
             f.__setattr__(i, kw[i])
         return f
     return attr_dec
+
+
+class MediaCache:
+    """
+    Disk-backed, size-bounded LRU cache of converted media files.
+
+    Entries are stored under `path`, named by the SHA-1 of their key, so
+    that the cache survives restarts. Keys should be derived from the
+    content of the source media, e.g. `MediaCache.hash_file(path)` or a
+    file ID issued by the remote platform.
+
+    Args:
+        path (str): Directory to store cached files.
+        max_size (int): Maximum total size of the cache in bytes.
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        files = [os.path.join(path, i) for i in os.listdir(path)]
+        for i in sorted(files, key=os.path.getatime):
+            self._entries[os.path.basename(i)] = os.path.getsize(i)
+            self.size += self._entries[os.path.basename(i)]
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def hash_file(path):
+        """
+        Get the SHA-1 hex digest of the content of a file.
+
+        Args:
+            path (str): Path to the file.
+
+        Returns:
+            str: Hex digest.
+        """
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def _link(src, dest):
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copyfile(src, dest)
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def get(self, key, dest):
+        """
+        Copy a cached file to `dest`, if `key` is cached.
+
+        The file is hard linked where possible, so `dest` can be removed
+        by its consumer without affecting the cache.
+
+        Args:
+            key (str): Cache key.
+            dest (str): Path to place the cached file.
+
+        Returns:
+            bool: `True` if the entry is found and copied.
+        """
+        name = hashlib.sha1(key.encode()).hexdigest()
+        with self._lock:
+            if name not in self._entries:
+                return False
+            self._entries.move_to_end(name)
+            cached = os.path.join(self.path, name)
+            try:
+                os.utime(cached)
+                self._link(cached, dest)
+            except OSError:
+                self.size -= self._entries.pop(name)
+                return False
+        return True
+
+    def put(self, key, src):
+        """
+        Store a copy of `src` in the cache as `key`.
+
+        Args:
+            key (str): Cache key.
+            src (str): Path to the file to be cached.
+        """
+        name = hashlib.sha1(key.encode()).hexdigest()
+        with self._lock:
+            self._link(src, os.path.join(self.path, name))
+            self.size -= self._entries.pop(name, 0)
+            self._entries[name] = os.path.getsize(src)
+            self.size += self._entries[name]
+            self._evict()
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Args:
+        rate (float): Tokens refilled per second.
+        burst (int): Maximum number of tokens in the bucket.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, now=None):
+        """
+        Get the time to wait until a token is available.
+
+        Args:
+            now (float): Current `time.monotonic()` value.
+
+        Returns:
+            float: Time to wait in seconds, 0 if a token is available.
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.until > now:
+            return self.until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """Take a token from the bucket."""
+        self.tokens -= 1
+
+    def hold(self, seconds):
+        """
+        Hold back all tokens for a period of time.
+
+        Args:
+            seconds (float): Time in seconds.
+        """
+        self.until = max(self.until, time.monotonic() + seconds)
+
+
+class SendScheduler:
+    """
+    Scheduler admitting outgoing messages under a global and a
+    per-recipient token bucket.
+
+    Senders call `acquire` before sending, which blocks until the message
+    may be sent. Messages to the same recipient are admitted in the order
+    they are queued. Among recipients ready to receive, messages with a
+    lower `priority` value are admitted first.
+
+    Queues handing messages over to a limited number of senders can
+    `reserve` the budget of a recipient beforehand, so that senders are
+    not held up by recipients over their budget. An `acquire` for a
+    recipient with a reservation only waits for the global budget.
+
+    Args:
+        rate (float): Global messages per second.
+        burst (int): Global burst size.
+        key_rate (float): Messages per second per recipient.
+        key_burst (int): Burst size per recipient.
+    """
+
+    def __init__(self, rate, burst, key_rate, key_burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self._buckets = {}
+        self._reserved = {}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.sent = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _key_bucket(self, key):
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(self.key_rate, self.key_burst)
+        return self._buckets[key]
+
+    def _next(self, now):
+        """
+        Find the next message to be admitted.
+
+        Returns:
+            tuple: The ticket of the message, or `None` if no recipient is
+                ready, and the time to wait in seconds until it can be admitted.
+        """
+        heads = {}
+        for ticket in self._waiting:
+            heads.setdefault(ticket[2], ticket)
+        delay = None
+        for ticket in sorted(heads.values()):
+            d = 0 if self._reserved.get(ticket[2]) else self._key_bucket(ticket[2]).delay(now)
+            if not d:
+                return ticket, self.bucket.delay(now)
+            delay = d if delay is None else min(delay, d)
+        return None, delay
+
+    def acquire(self, key, priority=0):
+        """
+        Wait until a message to `key` can be sent.
+
+        Args:
+            key (str): Recipient of the message.
+            priority (int): Priority of the message, lower values first.
+
+        Returns:
+            float: Time waited in the queue in seconds.
+        """
+        start = time.monotonic()
+        ticket = (priority, next(self._seq), key)
+        with self._cond:
+            self._waiting.append(ticket)
+            self._cond.notify_all()
+            try:
+                while True:
+                    now = time.monotonic()
+                    best, delay = self._next(now)
+                    if best is ticket and not delay:
+                        self.bucket.consume()
+                        if self._reserved.get(key):
+                            self._reserved[key] -= 1
+                        else:
+                            self._key_bucket(key).consume()
+                        break
+                    # Woken up by new or admitted messages, or when the
+                    # next message can be admitted.
+                    self._cond.wait(delay if best is ticket or best is None else None)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            self.sent += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def reserve(self, key):
+        """
+        Reserve the budget of a recipient for a message, if available.
+
+        Args:
+            key (str): Recipient of the message.
+
+        Returns:
+            float: 0 if the budget is reserved, otherwise the time to wait
+                in seconds until it is available.
+        """
+        with self._cond:
+            bucket = self._key_bucket(key)
+            delay = bucket.delay()
+            if not delay:
+                bucket.consume()
+                self._reserved[key] = self._reserved.get(key, 0) + 1
+                self._cond.notify_all()
+            return delay
+
+    def release(self, key):
+        """
+        Return a budget reserved with `reserve` but not used by `acquire`.
+
+        Args:
+            key (str): Recipient of the message.
+        """
+        with self._cond:
+            if self._reserved.get(key):
+                self._reserved[key] -= 1
+                bucket = self._key_bucket(key)
+                bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+                self._cond.notify_all()
+
+    def pause(self, key, seconds):
+        """
+        Stop admitting messages to a recipient for a period of time,
+        e.g. when the remote server asks to retry later. Messages to other
+        recipients are not affected.
+
+        Args:
+            key (str): Recipient to pause.
+            seconds (float): Time in seconds.
+        """
+        with self._cond:
+            self._key_bucket(key).hold(seconds)
+            self._cond.notify_all()
+
+    def qsize(self):
+        """
+        Returns:
+            int: Number of messages waiting to be admitted.
+        """
+        return len(self._waiting)
+
+    def stats(self):
+        """
+        Get queue-time metrics of the scheduler.
+
+        Returns:
+            dict: Number of messages `sent`, `waiting`, and the average and
+                maximum queue time in seconds (`wait_avg`, `wait_max`).
+        """
+        with self._cond:
+            return {
+                "sent": self.sent,
+                "waiting": len(self._waiting),
+                "wait_avg": self.wait_total / self.sent if self.sent else 0.0,
+                "wait_max": self.wait_max
+            }
+
+
+class MsgQueue(queue.Queue):
+    """
+    Message queue between channels with priority lanes.
+
+    System messages and text go first, then images and audio, then videos
+    and files. Messages in the same lane are delivered in order. A message
+    waiting longer than `max_wait` seconds is delivered before messages of
+    higher priority, so that bulk media is not starved.
+
+    The lanes take effect when the consumer takes messages only as fast
+    as it can deliver them, e.g. with a bounded number of delivery
+    threads. Messages of a chat in different lanes may then be delivered
+    out of order; consumers needing the original order should sort them
+    by `EFBMsg.time`.
+
+    Args:
+        maxsize (int): Maximum size of the queue, 0 for unlimited.
+        max_wait (float): Time in seconds before a message is delivered regardless of priority.
+    """
+    HIGH = 0
+    MEDIUM = 1
+    LOW = 2
+
+    def __init__(self, maxsize=0, max_wait=10):
+        self.max_wait = max_wait
+        super().__init__(maxsize)
+
+    @classmethod
+    def priority(cls, msg):
+        """
+        Get the priority lane of a message.
+
+        Args:
+            msg (channel.EFBMsg): The message.
+
+        Returns:
+            int: The lane, `MsgQueue.HIGH`, `MsgQueue.MEDIUM` or `MsgQueue.LOW`.
+        """
+        if msg.source == MsgSource.System:
+            return cls.HIGH
+        if msg.type in (MsgType.Video, MsgType.File):
+            return cls.LOW
+        if msg.type in (MsgType.Image, MsgType.Sticker, MsgType.Audio):
+            return cls.MEDIUM
+        return cls.HIGH
+
+    def _init(self, maxsize):
+        self.lanes = (deque(), deque(), deque())
+
+    def _qsize(self):
+        return sum(len(i) for i in self.lanes)
+
+    def _put(self, item):
+        self.lanes[self.priority(item)].append((time.monotonic(), item))
+
+    def _get(self):
+        now = time.monotonic()
+        lanes = [i for i in self.lanes if i]
+        oldest = min(lanes, key=lambda i: i[0][0])
+        if now - oldest[0][0] >= self.max_wait:
+            return oldest.popleft()[1]
+        return lanes[0].popleft()[1]